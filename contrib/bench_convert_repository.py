@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time `convert_managed_repository` on an in-memory environment.
+
+Usage: bench_convert_repository.py [repositories] [iterations]
+
+The environment is a `trac.test.EnvironmentStub` with the given number
+of managed repositories. Conversions are done on instances of a stub
+repository class, so no version control backend is needed. Three cases
+are measured:
+
+ * converting a fresh repository instance (new object per call),
+ * converting an instance that is already converted,
+ * converting after the managed metadata was invalidated.
+"""
+
+import sys
+import timeit
+
+from trac.test import EnvironmentStub
+
+from repo_mgr.api import RepositoryManager, convert_managed_repository
+
+
+class StubRepository(object):
+    """Stands in for a backend repository class."""
+
+    def __init__(self, reponame):
+        self.reponame = reponame
+
+
+def setup_env(count):
+    env = EnvironmentStub(enable=['trac.*', 'repo_mgr.api.*'])
+    rm = RepositoryManager(env)
+    with env.db_transaction as db:
+        rm.upgrade_environment(db)
+        for id in range(1, count + 1):
+            attrs = {'name': 'repo%d' % id,
+                     'dir': '/tmp/repo%d' % id,
+                     'type': 'stub',
+                     'owner': 'owner%d' % (id % 10),
+                     'maintainers': 'alice,bob',
+                     'writers': 'carol',
+                     'readers': 'authenticated'}
+            if id > 1 and id % 4 == 0:
+                attrs['origin'] = '1'
+            db.executemany("""
+                INSERT INTO repository (id, name, value) VALUES (%s, %s, %s)
+                """, [(id, name, value) for name, value in attrs.iteritems()])
+    rm.manager.reload_repositories()
+    return env
+
+
+def main(args):
+    count = int(args[0]) if len(args) > 0 else 500
+    iterations = int(args[1]) if len(args) > 1 else 10000
+    env = setup_env(count)
+    names = ['repo%d' % id for id in range(1, count + 1)]
+
+    def fresh():
+        for name in names[:10]:
+            convert_managed_repository(env, StubRepository(name))
+
+    converted = [StubRepository(name) for name in names[:10]]
+    fresh()
+    for repo in converted:
+        convert_managed_repository(env, repo)
+
+    def repeated():
+        for repo in converted:
+            convert_managed_repository(env, repo)
+
+    rm = RepositoryManager(env)
+
+    def invalidated():
+        del rm.managed_metadata
+        repeated()
+
+    for label, func, number in (('fresh instance', fresh, iterations),
+                                ('already converted', repeated, iterations),
+                                ('after invalidation', invalidated,
+                                 max(1, iterations // 100))):
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-20s %8.2f us per conversion' % (
+              label, seconds / (number * 10) * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare the `hardlink` and `pull` fork modes of hg repositories.
+
+Usage: bench_hg_fork.py [origin] [forks]
+
+Clones `origin` (or, if omitted, a generated repository with 2000
+changesets) `forks` times the way `MercurialConnector.fork` does in
+each mode and reports the time per fork and the disk space the forks
+need in addition to the origin. Blocks shared via hardlinks are only
+counted once.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import hglib
+
+
+def create_origin(directory, changesets=2000, files=50):
+    """Create a repository with some history to fork from."""
+    hglib.init(directory)
+    client = hglib.open(directory)
+    try:
+        for i in range(changesets):
+            path = os.path.join(directory, 'file%d.txt' % (i % files))
+            with open(path, 'a') as f:
+                f.write('line %d of changeset %d\n' % (i, i) * 20)
+            client.commit('Changeset %d' % i, addremove=True,
+                          user='bench <bench@example.org>')
+    finally:
+        client.close()
+
+
+def additional_disk_usage(origin, directories):
+    """Return the bytes used by `directories` that are not shared with
+    `origin` via hardlinks.
+    """
+    seen = set()
+    for root, dirs, files in os.walk(origin):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            seen.add((st.st_dev, st.st_ino))
+
+    total = 0
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                st = os.lstat(os.path.join(root, name))
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+    return total
+
+
+def fork(origin, directory, mode):
+    if mode == 'hardlink':
+        hglib.clone(origin, directory, updaterev='null', pull=False)
+    else:
+        hglib.clone('file://' + origin, directory, updaterev='null',
+                    pull=True)
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='bench_hg_fork.')
+    try:
+        if args:
+            origin = os.path.abspath(args[0])
+        else:
+            origin = os.path.join(workdir, 'origin')
+            create_origin(origin)
+        count = int(args[1]) if len(args) > 1 else 5
+
+        for mode in ('hardlink', 'pull'):
+            directories = [os.path.join(workdir, '%s%d' % (mode, i))
+                           for i in range(count)]
+            start = time.time()
+            for directory in directories:
+                fork(origin, directory, mode)
+            seconds = (time.time() - start) / count
+            usage = additional_disk_usage(origin, directories) / count
+            print('%-8s %8.3f s per fork %10.1f KiB per fork' % (
+                  mode, seconds, usage / 1024.0))
+            for directory in directories:
+                shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
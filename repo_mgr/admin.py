@@ -1,4 +1,5 @@
 from api import *
+from jobs import RepositoryJobQueue
 
 from trac.core import *
 from trac.perm import PermissionSystem
@@ -12,6 +13,11 @@ from trac.util.translation import _
 
 from itertools import izip_longest
 
+import csv
+import shutil
+import sys
+import tempfile
+
 class RepositoryAdmin(Component):
     """Adds creation, modification and deletion of repositories.
 
@@ -34,6 +40,16 @@ class RepositoryAdmin(Component):
         yield ('repository create', '<repos> <type> <owner> [dir]',
                "Create a new managed repository",
                self._complete_create, self._do_create)
+        yield ('repository create_batch', '<manifest>',
+               """Create many new managed repositories at once
+
+               The manifest is a CSV file with a header row and the
+               columns name, type, owner, dir and roles. dir is
+               optional and relative to the base directory of the type.
+               roles is a space separated list of role:subject pairs,
+               e.g. "writer:alice reader:@developers".
+               """,
+               self._complete_create_batch, self._do_create_batch)
         yield ('repository fork', '<repos> <type> [dir]',
                "Fork an existing managed repository",
                self._complete_create, self._do_fork)
@@ -46,6 +62,10 @@ class RepositoryAdmin(Component):
 
                If <delete from disk> is 'true', contents are also removed
                permanently from disk.
+
+               The contents and cached changesets are deleted right
+               away, or by the `repository job_worker` daemon if
+               `job_worker = daemon` is configured.
                """,
                self._complete_remove_managed, self._do_remove_managed)
         attrs = set(DbRepositoryProvider(self.env).repository_attrs)
@@ -58,12 +78,37 @@ class RepositoryAdmin(Component):
                The following keys are supported: %s
                """ % ", ".join(attrs - set(['type'])),
                self._complete_set_managed, self._do_set)
+        yield ('repository adjust_modes', '[repos] [...]',
+               """Repair the file modes of managed repositories
+
+               Sets modes 770 and 660 for all directories and files of
+               the given or, if none is given, all managed repositories.
+               """,
+               self._complete_managed_repositories, self._do_adjust_modes)
         yield ('repository list_managed', '',
                "List only managed repositories",
                None, self._do_list_managed)
         yield ('repository list_unmanaged', None,
                "List only unmanaged repositories",
                None, self._do_list_unmanaged)
+        yield ('repository purge_removed', '',
+               """Delete removed repositories from disk and cache
+
+               Drains the trash of repositories that were removed via
+               `repository remove_managed` or the web interface.
+               """,
+               None, self._do_purge_removed)
+        yield ('repository job_worker', '[interval]',
+               """Execute queued repository operations
+
+               Runs forever and polls for new jobs every [interval]
+               seconds (default: 5). Use together with `job_worker =
+               daemon` in the [repository-manager] section.
+               """,
+               None, self._do_job_worker)
+        yield ('repository job_list', '',
+               "List recent repository operations",
+               None, self._do_job_list)
         yield ('role add', '<repos> <role> <user> [user] [...]',
                """Add a new role
 
@@ -74,10 +119,18 @@ class RepositoryAdmin(Component):
                "Remove an existing role",
                self._complete_role_remove, self._do_role_remove)
         yield ('role export', '[file]',
-               "Export repository roles to a file or stdout as CSV",
+               """Export repository roles to a file or stdout as CSV
+
+               Every row has the columns repository, role and subject.
+               """,
                None, self._do_role_export)
         yield ('role import', '[file]',
-               "Import repository roles from a file or stdin as CSV",
+               """Import repository roles from a file or stdin as CSV
+
+               Every row has the columns repository, role and subject.
+               All rows are validated first and nothing is imported if
+               any of them is invalid. Existing roles are kept.
+               """,
                self._complete_role_import, self._do_role_import)
         yield ('role list', '<repos>',
                "List roles for given repository",
@@ -128,6 +181,10 @@ class RepositoryAdmin(Component):
             if repos:
                 return getattr(repos, '_' + args[1] + 's')
 
+    def _complete_create_batch(self, args):
+        if len(args) == 1:
+            return get_dir_list(args[-1])
+
     def _complete_role_import(self, args):
         if len(args) == 1:
             return get_dir_list(args[-1])
@@ -163,6 +220,48 @@ class RepositoryAdmin(Component):
                 'dir': directory}
         rm.create(repo)
 
+    def _do_create_batch(self, manifest):
+        rm = RepositoryManager(self.env)
+        try:
+            source = open(manifest, 'rb')
+        except IOError, e:
+            raise AdminCommandError(_("Cannot read %(file)s: %(error)s",
+                                      file=manifest, error=e.strerror))
+        repos = []
+        with source:
+            for line, row in enumerate(csv.DictReader(source), 2):
+                row = dict((key, (value or '').decode('utf-8').strip())
+                           for key, value in row.iteritems() if key)
+                if not (row.get('name') and row.get('type') and
+                        row.get('owner')):
+                    raise AdminCommandError(_("Line %(line)d: name, type "
+                                              "and owner are required",
+                                              line=line))
+                roles = []
+                for entry in row.get('roles', '').split():
+                    role, sep, subject = entry.partition(':')
+                    if not sep or not subject or ',' in subject:
+                        raise AdminCommandError(_("Line %(line)d: invalid "
+                                                  "role '%(role)s'",
+                                                  line=line, role=entry))
+                    roles.append((role, subject))
+                directory = os.path.join(rm.get_base_directory(row['type']),
+                                         row.get('dir') or row['name'])
+                repos.append({'name': row['name'],
+                              'type': row['type'],
+                              'owner': row['owner'],
+                              'dir': directory,
+                              'roles': roles})
+        if not repos:
+            return
+
+        failed = rm.create_batch(repos, printout)
+        for name, message in failed:
+            printout(_("Failed to create %(name)s: %(message)s",
+                       name=name, message=message))
+        printout(_("Created %(count)d repositories",
+                   count=len(repos) - len(failed)))
+
     def _do_fork(self):
         printout("fork")
 
@@ -173,6 +272,47 @@ class RepositoryAdmin(Component):
             raise AdminCommandError(_('Repository "%(name)s" does not exists',
                                       name=name))
         rm.remove(repository, as_bool(delete))
+        jobs = RepositoryJobQueue(self.env)
+        if jobs.worker == 'inprocess':
+            # A worker thread would not outlive this command
+            rm.purge_removed(printout)
+        else:
+            jobs.submit('purge_removed', '', {}, 'trac-admin')
+
+    def _do_adjust_modes(self, *names):
+        rm = RepositoryManager(self.env)
+        repositories = None
+        if names:
+            repositories = []
+            for name in names:
+                repository = rm.get_repository(name, True)
+                if not repository:
+                    raise AdminCommandError(_('Repository "%(name)s" does '
+                                              'not exists', name=name))
+                repositories.append(repository)
+        changed = rm.repair_modes(repositories)
+        printout(_("Adjusted modes of %(count)d files and directories",
+                   count=changed))
+
+    def _do_purge_removed(self):
+        count = RepositoryManager(self.env).purge_removed(printout)
+        printout(_("Purged %(count)d removed repositories", count=count))
+
+    def _do_job_worker(self, interval='5'):
+        try:
+            interval = float(interval)
+        except ValueError:
+            raise AdminCommandError(_("Invalid interval %(interval)s",
+                                      interval=interval))
+        RepositoryJobQueue(self.env).run_worker(interval)
+
+    def _do_job_list(self):
+        jobs = RepositoryJobQueue(self.env).get_jobs(limit=100)
+        print_table([(job['id'], job['action'], job['reponame'],
+                      job['submitter'], job['status'],
+                      job['message'] or job['progress']) for job in jobs],
+                    [_("Id"), _("Action"), _("Repository"), _("Submitter"),
+                     _("Status"), _("Progress")])
 
     def _do_set(self):
         printout("set")
@@ -214,19 +354,95 @@ class RepositoryAdmin(Component):
         rm = RepositoryManager(self.env)
         for subject in set([user]) | set(users):
             rm.add_role(rm.get_repository(repos, True), role, subject)
-        rm.update_auth_files()
+        rm.update_auth_files(incremental=True)
 
     def _do_role_remove(self, repos, role, user, *users):
         rm = RepositoryManager(self.env)
         roles = ((role, subject) for subject in set([user]) | set(users))
         rm.revoke_roles(rm.get_repository(repos, True), roles)
-        rm.update_auth_files()
+        rm.update_auth_files(incremental=True)
 
     def _do_role_export(self, file=None):
-        printout("role export")
+        rm = RepositoryManager(self.env)
+        if file and file != '-':
+            out = open(file, 'wb')
+        else:
+            out = sys.stdout
+        try:
+            writer = csv.writer(out)
+            for row in rm.export_roles():
+                writer.writerow([value.encode('utf-8') for value in row])
+        finally:
+            if out is not sys.stdout:
+                out.close()
 
     def _do_role_import(self, file=None):
-        printout("role import")
+        rm = RepositoryManager(self.env)
+        if file and file != '-':
+            try:
+                source = open(file, 'rb')
+            except IOError, e:
+                raise AdminCommandError(_("Cannot read %(file)s: %(error)s",
+                                          file=file, error=e.strerror))
+        else:
+            # Spool stdin as the rows are read twice
+            source = tempfile.TemporaryFile()
+            shutil.copyfileobj(sys.stdin, source)
+        try:
+            self._validate_roles(self._read_roles(source))
+            source.seek(0)
+            count = rm.import_roles(row for line, row
+                                    in self._read_roles(source))
+        finally:
+            source.close()
+        printout(_("Updated roles of %(count)d repositories", count=count))
+
+    def _read_roles(self, source):
+        """Yield `line, (reponame, role, subject)` for the rows of a
+        CSV file. Rows without the expected number of columns are
+        yielded as `line, None`.
+        """
+        for line, row in enumerate(csv.reader(source), 1):
+            if not row:
+                continue
+            if len(row) != 3:
+                yield line, None
+                continue
+            try:
+                yield line, tuple(value.decode('utf-8').strip()
+                                  for value in row)
+            except UnicodeDecodeError:
+                yield line, None
+
+    def _validate_roles(self, rows):
+        """Check all rows before anything is imported."""
+        rm = RepositoryManager(self.env)
+        reponames = set(info['name']
+                        for info in rm.managed_metadata.itervalues())
+        errors = []
+        count = 0
+        for line, row in rows:
+            if row is None:
+                error = _("expected 'repository,role,subject'")
+            elif row[0] not in reponames:
+                error = _("'%(repo)s' is not a managed repository",
+                          repo=row[0])
+            elif row[1] not in rm.roles:
+                error = _("unknown role '%(role)s'", role=row[1])
+            elif not row[2] or ',' in row[2]:
+                error = _("invalid subject '%(subject)s'", subject=row[2])
+            else:
+                continue
+            count += 1
+            if len(errors) < 10:
+                errors.append(_("Line %(line)d: %(error)s",
+                                line=line, error=error))
+        if count:
+            if count > len(errors):
+                errors.append(_("... and %(count)d more errors",
+                                count=count - len(errors)))
+            raise AdminCommandError(_("Nothing imported:\n%(errors)s",
+                                      errors='\n'.join(errors)))
 
     def _do_role_list(self, repos):
         repository = RepositoryManager(self.env).get_repository(repos, True)
@@ -249,4 +465,9 @@ class RepositoryAdmin(Component):
         print_table(values, columns)
 
     def _do_write_auth_files(self):
-        RepositoryManager(self.env).update_auth_files()
+        count = RepositoryManager(self.env).update_auth_files()
+        if count is None:
+            printout(_("Another process is rewriting the auth files and "
+                       "will include this rebuild"))
+        else:
+            printout(_("Changed %(count)d auth files", count=count))
@@ -1,17 +1,46 @@
 from trac.core import *
+from trac.env import IEnvironmentSetupParticipant
+from trac.db import DatabaseManager
 from trac.versioncontrol.api import RepositoryManager as TracRepositoryManager
 from trac.versioncontrol.svn_authz import AuthzSourcePolicy
 from trac.perm import PermissionSystem
 from trac.util import as_bool
+from trac.util.text import exception_to_unicode
 from trac.util.translation import _
-from trac.config import Option, BoolOption
+from trac.config import Option, BoolOption, IntOption
+from trac.cache import CacheManager, cached
 
 from ConfigParser import ConfigParser
+from itertools import groupby
+from operator import itemgetter
+from StringIO import StringIO
 
+import db_default
 import os
 import errno
+import hashlib
+import tempfile
 import stat
 import shutil
+import sys
+import threading
+import time
+
+from multiprocessing import Pool
+from Queue import Queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 class IAdministrativeRepositoryConnector(Interface):
     """Provide support for a specific version control system.
@@ -57,8 +86,43 @@ class IAdministrativeRepositoryConnector(Interface):
     def delete_changeset(repository, revision, ban):
         """Delete (and optionally ban) a changeset from the repository."""
 
-    def update_auth_files(repositories):
-        """Write auth information to e.g. authz for .hgrc files"""
+    def get_existing_revisions(repository, revs):
+        """Return the set of the given revisions that exist in the
+        repository, answered with as few backend queries as possible.
+        """
+
+    def get_ahead_behind(repository, rev, other):
+        """Return a `(ahead, behind)` pair with the number of changesets
+        up to `rev` in `repository` that are missing in the repository
+        `other` and the number of changesets of `other` that are
+        missing in `repository`. Return `None` if not supported.
+        """
+
+    def get_descendants(repository, rev, start, limit):
+        """Return at most `limit` revisions of the branch of `rev` that
+        descend from `rev`, in ascending order and beginning at the
+        revision `start`. Return `None` if not supported.
+        """
+
+    def get_merge_base(repository, rev, other):
+        """Return the youngest ancestor of `rev` in `repository` that
+        also exists in the repository `other` or `None` if there is
+        none. Return `False` if not supported.
+        """
+
+    def update_auth_files(repositories, incremental=False, groups=None):
+        """Write auth information to e.g. authz for .hgrc files
+
+        If `incremental` is true, `repositories` only contains the
+        repositories that changed and the auth information of all other
+        repositories must be kept.
+
+        `groups` is a `UserGroups` instance that should be used to
+        expand user sets. It is resolved once per rebuild.
+
+        Files should be written with `write_auth_file`. Returns the
+        number of files that were actually changed.
+        """
 
 class RepositoryManager(Component):
     """Adds creation, modification and deletion of repositories.
@@ -88,14 +152,147 @@ class RepositoryManager(Component):
                                             administrator for his repositories.
                                             """)
 
+    implements(IEnvironmentSetupParticipant)
+
+    purge_batch_size = IntOption('repository-manager', 'purge_batch_size',
+                                 1000,
+                                 doc="""Number of cached changesets of a
+                                        removed repository that are deleted
+                                        per database transaction.
+                                        """)
+    adjust_modes_threads = IntOption('repository-manager',
+                                     'adjust_modes_threads', 4,
+                                     doc="""Number of threads used to adjust
+                                            the file modes of a repository.
+                                            """)
+    create_batch_processes = IntOption('repository-manager',
+                                       'create_batch_processes', 4,
+                                       doc="""Number of processes that
+                                              create repositories in
+                                              parallel for `create_batch`.
+                                              """)
+
     connectors = ExtensionPoint(IAdministrativeRepositoryConnector)
 
     manager = None
 
     roles = ('maintainer', 'writer', 'reader')
 
+    _repository_ids = (None, {})
+
     def __init__(self):
         self.manager = TracRepositoryManager(self.env)
+        self._dirty_repositories = set()
+        self._dirty_lock = threading.Lock()
+
+    @cached
+    def managed_metadata(self):
+        """Return the attributes of all managed repositories indexed by
+        their id.
+
+        All rows of the `repository` table are loaded with a single
+        query and reduced to one record per managed repository. The
+        result is shared between requests and invalidated via a
+        generation counter whenever a managed repository changes.
+        """
+        rows = {}
+        for id, name, value in self.env.db_query(
+                "SELECT id, name, value FROM repository"):
+            rows.setdefault(id, {})[name] = value
+
+        metadata = {}
+        for id, attrs in rows.iteritems():
+            if 'owner' not in attrs:
+                continue
+            info = {'name': attrs.get('name'),
+                    'owner': attrs['owner'],
+                    'origin': None,
+                    'origin_name': None,
+                    'inherit_readers': as_bool(attrs.get('inherit_readers'))}
+            for role in self.roles:
+                value = attrs.get(role + 's')
+                info[role + 's'] = frozenset(value.split(',') if value else [])
+            if attrs.get('origin'):
+                origin = int(attrs['origin'])
+                if rows.get(origin, {}).get('name'):
+                    info['origin'] = origin
+                    info['origin_name'] = rows[origin]['name']
+            metadata[id] = info
+        return metadata
+
+    @cached
+    def access_index(self):
+        """Return which users can read which managed repositories.
+
+        The result is a dict with the frozensets `managed` of all
+        managed repository names, `anonymous` and `authenticated` of
+        the names readable by everybody or by every authenticated user,
+        and `users`, which maps user names to the frozenset of names
+        they can read in addition. Groups are expanded to their members.
+        """
+        user_groups = UserGroups(self.env)
+        managed = set()
+        anonymous = set()
+        authenticated = set()
+        users = {}
+        for repo in self._get_all_managed_repositories():
+            name = repo.reponame
+            managed.add(name)
+            readers = user_groups.expand(repo.maintainers() | repo.writers() |
+                                         repo.readers())
+            if 'anonymous' in readers:
+                anonymous.add(name)
+            elif 'authenticated' in readers:
+                authenticated.add(name)
+            else:
+                for user in readers:
+                    users.setdefault(user, set()).add(name)
+        return {'managed': frozenset(managed),
+                'anonymous': frozenset(anonymous),
+                'authenticated': frozenset(authenticated),
+                'users': dict((user, frozenset(names))
+                              for user, names in users.iteritems())}
+
+    ### IEnvironmentSetupParticipant methods
+    def environment_created(self):
+        with self.env.db_transaction as db:
+            self.upgrade_environment(db)
+
+    def environment_needs_upgrade(self, db):
+        return self._get_schema_version(db) < db_default.version
+
+    def upgrade_environment(self, db):
+        current = self._get_schema_version(db)
+        connector = DatabaseManager(self.env).get_connector()[0]
+        upgrades = db_default.get_upgrades()
+        for version in range(current + 1, db_default.version + 1):
+            for step in upgrades.get(version, []):
+                if callable(step):
+                    step(self.env, db)
+                    continue
+                for statement in connector.to_sql(step):
+                    db(statement)
+        if current:
+            db("UPDATE system SET value = %s WHERE name = %s",
+               (db_default.version, db_default.name))
+        else:
+            db("INSERT INTO system (name, value) VALUES (%s, %s)",
+               (db_default.name, db_default.version))
+
+    def refresh(self):
+        """Pick up changes that other processes made to the managed
+        repositories.
+
+        The cache generations are checked again and Trac's list of
+        repositories is read again. Unlike Trac's
+        `reload_repositories`, this does not touch trac.ini, which
+        would make every process reload its environment.
+        """
+        CacheManager(self.env).reset_metadata()
+        manager = self.manager
+        with manager._lock:
+            manager._cache = {}
+            manager._all_repositories = None
 
     def get_supported_types(self):
         """Return the list of supported repository types."""
@@ -143,6 +340,31 @@ class RepositoryManager(Component):
                 pass
         return result
 
+    def get_accessible_repositories(self, username):
+        """Return the set of names of the managed repositories that the
+        given user can read.
+        """
+        index = self.access_index
+        names = set(index['anonymous'])
+        if username and username != 'anonymous':
+            names |= index['authenticated']
+            names |= index['users'].get(username, frozenset())
+        return names
+
+    def can_read(self, username, reponame):
+        """Return whether the given user can read the given repository
+        or `None` if it is not a managed repository.
+        """
+        index = self.access_index
+        if reponame not in index['managed']:
+            return None
+        if reponame in index['anonymous']:
+            return True
+        if not username or username == 'anonymous':
+            return False
+        return (reponame in index['authenticated'] or
+                reponame in index['users'].get(username, ()))
+
     def get_repository(self, name, convert_to_managed=False):
         """Retrieve the appropriate repository for the given name.
 
@@ -155,13 +377,53 @@ class RepositoryManager(Component):
             convert_managed_repository(self.env, repo)
         return repo
 
+    def is_managed(self, name):
+        """Return whether the repository with the given name is managed
+        by this `RepositoryManager`.
+        """
+        info = self.manager.get_all_repositories().get(name)
+        return bool(info and info.get('id') in self.managed_metadata)
+
+    def get_request_repository(self, req, name):
+        """Retrieve the given repository converted into a
+        `ManagedRepository` or `None` if it is not managed.
+
+        The result is memoized for the lifetime of `req`, so that all
+        filters and handlers of a request share a single lookup.
+        """
+        memo = req.environ.setdefault('repo_mgr.repositories', {})
+        if name not in memo:
+            repo = None
+            if self.is_managed(name):
+                try:
+                    repo = self.get_repository(name, True)
+                except TracError:
+                    pass
+            memo[name] = repo
+        return memo[name]
+
     def get_repository_by_id(self, id, convert_to_managed=False):
         """Retrieve a matching `Repository` for the given id."""
-        repositories = self.manager.get_all_repositories()
-        for name, info in repositories.iteritems():
-            if info['id'] == int(id):
-                return self.get_repository(name, convert_to_managed)
-        return None
+        name = self._get_repository_names_by_id().get(int(id))
+        if name is None:
+            return None
+        return self.get_repository(name, convert_to_managed)
+
+    def get_repositories_by_ids(self, ids, convert_to_managed=False):
+        """Retrieve the matching `Repository` for each of the given ids.
+
+        The result is a list in the order of `ids` that contains `None`
+        for unknown ids.
+        """
+        names = self._get_repository_names_by_id()
+        result = []
+        for id in ids:
+            name = names.get(int(id))
+            if name is None:
+                result.append(None)
+            else:
+                result.append(self.get_repository(name, convert_to_managed))
+        return result
 
     def get_repository_by_path(self, path):
         """Retrieve a matching `Repository` for the given path."""
@@ -171,7 +433,7 @@ class RepositoryManager(Component):
         """Get the base directory for the given repository type."""
         return os.path.join(self.env.path, self.base_dir, type)
 
-    def create(self, repo):
+    def create(self, repo, progress=None):
         """Create a new empty repository.
 
          * Checks if the new repository can be created and added
@@ -180,14 +442,20 @@ class RepositoryManager(Component):
            repository
          * Postprocesses the filesystem (modes)
          * Inserts everything into the database and synchronizes Trac
+
+        The optional callable `progress` is called with a message
+        whenever a new step is started.
         """
+        progress = progress or (lambda message: None)
         if self.get_repository(repo['name']) or os.path.lexists(repo['dir']):
             raise TracError(_("Repository or directory already exists."))
 
         self._prepare_base_directory(repo['dir'])
 
+        progress(_("Creating repository"))
         self._get_repository_connector(repo['type']).create(repo)
 
+        progress(_("Adjusting file modes"))
         self._adjust_modes(repo['dir'])
 
         with self.env.db_transaction as db:
@@ -198,11 +466,98 @@ class RepositoryManager(Component):
                 [(id, 'dir', repo['dir']),
                  (id, 'type', repo['type']),
                  (id, 'owner', repo['owner'])] + roles)
+            self._invalidate_metadata()
             self.manager.reload_repositories()
+        progress(_("Synchronizing repository"))
         self.manager.get_repository(repo['name']).sync(None, True)
-        self.update_auth_files()
+        progress(_("Writing auth files"))
+        self._mark_dirty(id)
+        self.update_auth_files(incremental=True)
+
+    def create_batch(self, repos, progress=None):
+        """Create many new empty repositories at once.
+
+        Every item of `repos` is a dict like the one passed to `create`
+        with an additional `roles` list of `role, subject` pairs. The
+        connectors are run in a pool of `create_batch_processes`
+        processes. All successfully created repositories are then
+        inserted within a single transaction, and Trac's repositories
+        and the auth files are reloaded only once.
+
+        Returns a list of `name, message` pairs for the repositories
+        that could not be created.
+        """
+        progress = progress or (lambda message: None)
+        names = set(self.manager.get_all_repositories())
+        directories = set()
+        types = self.get_supported_types()
+        for repo in repos:
+            if repo['name'] in names or repo['dir'] in directories or \
+                    os.path.lexists(repo['dir']):
+                raise TracError(_("Repository or directory %(name)s "
+                                  "already exists.", name=repo['name']))
+            if repo['type'] not in types:
+                raise TracError(_("Unsupported repository type %(type)s.",
+                                  type=repo['type']))
+            for role, subject in repo.get('roles', ()):
+                if role not in self.roles:
+                    raise TracError(_("Unknown role %(role)s.", role=role))
+            names.add(repo['name'])
+            directories.add(repo['dir'])
+
+        for repo in repos:
+            self._prepare_base_directory(repo['dir'])
+
+        progress(_("Creating %(count)d repositories", count=len(repos)))
+        global _batch_env
+        _batch_env = self.env
+        processes = max(1, min(self.create_batch_processes, len(repos)))
+        pool = Pool(processes)
+        try:
+            results = pool.map(_create_repository, repos)
+        finally:
+            pool.close()
+            pool.join()
+            _batch_env = None
+
+        failed = [(repo['name'], message)
+                  for repo, message in zip(repos, results) if message]
+        created = [repo for repo, message in zip(repos, results)
+                   if not message]
+        if not created:
+            return failed
+
+        progress(_("Adding %(count)d repositories", count=len(created)))
+        ids = []
+        with self.env.db_transaction as db:
+            rows = []
+            for repo in created:
+                id = self.manager.get_repository_id(repo['name'])
+                ids.append(id)
+                roles = dict((role, set()) for role in self.roles)
+                for role, subject in repo.get('roles', ()):
+                    roles[role].add(subject)
+                rows += [(id, 'dir', repo['dir']),
+                         (id, 'type', repo['type']),
+                         (id, 'owner', repo['owner'])]
+                rows += [(id, role + 's', ','.join(sorted(roles[role])))
+                         for role in self.roles]
+            db.executemany(
+                "INSERT INTO repository (id, name, value) VALUES (%s, %s, %s)",
+                rows)
+            self._invalidate_metadata()
+            self.manager.reload_repositories()
+
+        progress(_("Synchronizing repositories"))
+        for repo in created:
+            self.manager.get_repository(repo['name']).sync()
+        progress(_("Writing auth files"))
+        for id in ids:
+            self._mark_dirty(id)
+        self.update_auth_files(incremental=True)
+        return failed
 
-    def fork_local(self, repo):
+    def fork_local(self, repo, progress=None):
         """Fork a local repository.
 
          * Checks if the new repository can be created and added
@@ -211,7 +566,11 @@ class RepositoryManager(Component):
          * Uses an appropriate connector to fork the repository
          * Postprocesses the filesystem (modes)
          * Inserts everything into the database and synchronizes Trac
+
+        The optional callable `progress` is called with a message
+        whenever a new step is started.
         """
+        progress = progress or (lambda message: None)
         if self.get_repository(repo['name']) or os.path.lexists(repo['dir']):
             raise TracError(_("Repository or directory already exists."))
 
@@ -225,8 +584,10 @@ class RepositoryManager(Component):
 
         self._prepare_base_directory(repo['dir'])
 
+        progress(_("Forking repository"))
         self._get_repository_connector(repo['type']).fork(repo)
 
+        progress(_("Adjusting file modes"))
         self._adjust_modes(repo['dir'])
 
         with self.env.db_transaction as db:
@@ -240,41 +601,121 @@ class RepositoryManager(Component):
                  (id, 'description', origin.description),
                  (id, 'origin', origin.id),
                  (id, 'inherit_readers', True)] + roles)
+            seeded = self._seed_revision_cache(db, origin, id)
+            self._invalidate_metadata()
             self.manager.reload_repositories()
-        self.manager.get_repository(repo['name']).sync(None, True)
-        self.update_auth_files()
+        progress(_("Synchronizing repository"))
+        forked = self.manager.get_repository(repo['name'])
+        forked.sync(None, not (seeded and self._has_cached_youngest(forked)))
+        progress(_("Writing auth files"))
+        self._mark_dirty(id)
+        self.update_auth_files(incremental=True)
 
     def modify(self, repo, data):
         """Modify an existing repository."""
         convert_managed_repository(self.env, repo)
-        if repo.directory != data['dir']:
+        renamed = repo.reponame != data['name']
+        moved = repo.directory != data['dir']
+        if moved:
             shutil.move(repo.directory, data['dir'])
         with self.env.db_transaction as db:
             db.executemany(
                 "UPDATE repository SET value = %s WHERE id = %s AND name = %s",
                 [(data[key], repo.id, key) for key in data])
+            self._invalidate_metadata()
             self.manager.reload_repositories()
-        if repo.directory != data['dir']:
+        if moved:
             repo = self.get_repository(data['name'])
             repo.sync(clean=True)
-        self.update_auth_files()
-
-    def remove(self, repo, delete):
+        if renamed:
+            # Sections of the old name must disappear from shared files
+            self.update_auth_files()
+        else:
+            self._mark_dirty(repo.id)
+            self.update_auth_files(incremental=True)
+
+    def remove(self, repo, delete, progress=None):
         """Remove an existing repository.
 
         Depending on the parameter delete this method also removes the
         repository from the filesystem. This can not be undone.
+
+        The repository directory is only moved into the trash and the
+        repository is marked as removed. Its files and cached changesets
+        are deleted later by `purge_removed`.
+
+        The optional callable `progress` is called with a message
+        whenever a new step is started.
         """
+        progress = progress or (lambda message: None)
         convert_managed_repository(self.env, repo)
+        trash_path = ''
         if delete:
-            shutil.rmtree(repo.directory)
+            progress(_("Moving repository to trash"))
+            trash_path = self._move_to_trash(repo)
+        progress(_("Removing repository from database"))
         with self.env.db_transaction as db:
             db("DELETE FROM repository WHERE id = %d" % repo.id)
-            db("DELETE FROM revision WHERE repos = %d" % repo.id)
-            db("DELETE FROM node_change WHERE repos = %d" % repo.id)
+            db("""INSERT INTO repository (id, name, value)
+                  VALUES (%s, 'trash', %s)""", (repo.id, trash_path))
+            self._invalidate_ancestors(repo)
+            self._invalidate_metadata()
         self.manager.reload_repositories()
+        progress(_("Writing auth files"))
         self.update_auth_files()
 
+    def purge_removed(self, progress=None):
+        """Delete the files and cached changesets of removed
+        repositories.
+
+        Cached changesets are deleted in transactions of at most
+        `purge_batch_size` changesets, so that other requests are not
+        blocked for long. Returns the number of purged repositories.
+        """
+        progress = progress or (lambda message: None)
+        removed = self.env.db_query("""
+            SELECT id, value FROM repository WHERE name = 'trash'
+            """)
+        for id, trash_path in removed:
+            if trash_path and os.path.lexists(trash_path):
+                progress(_("Deleting files of removed repository"))
+                shutil.rmtree(trash_path)
+
+            progress(_("Deleting cached changesets of removed repository"))
+            while True:
+                with self.env.db_transaction as db:
+                    revs = [(id, rev) for rev, in db("""
+                        SELECT rev FROM revision WHERE repos = %s LIMIT %d
+                        """ % ('%s', self.purge_batch_size), (id,))]
+                    if not revs:
+                        break
+                    db.executemany("""DELETE FROM node_change
+                                      WHERE repos = %s AND rev = %s""", revs)
+                    db.executemany("""DELETE FROM revision
+                                      WHERE repos = %s AND rev = %s""", revs)
+
+            with self.env.db_transaction as db:
+                db("DELETE FROM node_change WHERE repos = %s", (id,))
+                db("DELETE FROM repository WHERE id = %s", (id,))
+        return len(removed)
+
+    def repair_modes(self, repositories=None):
+        """Adjust the file modes of the given or all managed
+        repositories.
+
+        Returns the number of files and directories that were changed.
+        """
+        if repositories is None:
+            repositories = []
+            for repo in self.manager.get_real_repositories():
+                try:
+                    convert_managed_repository(self.env, repo)
+                    repositories.append(repo)
+                except:
+                    pass
+        return sum(self._adjust_modes(repo.directory)
+                   for repo in repositories)
+
     def delete_changeset(self, repo, rev, ban):
         """Delete a changeset from a managed repository, if supported.
 
@@ -284,6 +725,64 @@ class RepositoryManager(Component):
         """
         convert_managed_repository(self.env, repo)
         self._get_repository_connector(repo.type).delete_changeset(repo, rev, ban)
+        self._invalidate_ancestors(repo)
+        # Stripping also removes descendants, so every pull request
+        # into this repository may have lost its merged changes
+        with self.env.db_transaction as db:
+            db("""UPDATE pull_request SET merged = NULL
+                  WHERE dstrepo = %s AND merged = 1""", (repo.id,))
+
+    def get_youngest_common_ancestor(self, repo, rev):
+        """Return the youngest ancestor of `rev` in the forked `repo`
+        that also exists in its origin.
+
+        Results are stored per fork and revision along with the youngest
+        revision of the origin at the time of computation, so that they
+        are recomputed as soon as the origin gains changesets.
+        """
+        convert_managed_repository(self.env, repo)
+        rev = unicode(rev)
+        origin_rev = unicode(repo.origin.get_youngest_rev())
+        for ancestor, in self.env.db_query("""
+                SELECT ancestor FROM repository_ancestor
+                WHERE repos = %s AND rev = %s AND origin_rev = %s
+                """, (repo.id, rev, origin_rev)):
+            return ancestor
+
+        connector = self._get_repository_connector(repo.type)
+        ancestor = connector.get_merge_base(repo, rev, repo.origin)
+        if ancestor is False:
+            ancestor = repo.get_youngest_common_ancestor(rev)
+        elif ancestor is not None:
+            ancestor = repo.normalize_rev(ancestor)
+        with self.env.db_transaction as db:
+            db("DELETE FROM repository_ancestor WHERE repos = %s AND rev = %s",
+               (repo.id, rev))
+            db("""INSERT INTO repository_ancestor
+                      (repos, rev, origin_rev, ancestor)
+                  VALUES (%s, %s, %s, %s)""",
+               (repo.id, rev, origin_rev,
+                unicode(ancestor) if ancestor is not None else None))
+        return ancestor
+
+    def get_ahead_behind(self, repo, rev):
+        """Return how many changesets up to `rev` the forked `repo` is
+        ahead of its origin and how many changesets of the origin it is
+        missing, or `None` if the connector cannot tell.
+        """
+        convert_managed_repository(self.env, repo)
+        if not repo.is_fork:
+            return None
+        connector = self._get_repository_connector(repo.type)
+        return connector.get_ahead_behind(repo, rev, repo.origin)
+
+    def get_descendants(self, repo, rev, start, limit):
+        """Return at most `limit` descendants of `rev` on its branch,
+        beginning at `start`, or `None` if the connector cannot tell.
+        """
+        convert_managed_repository(self.env, repo)
+        connector = self._get_repository_connector(repo.type)
+        return connector.get_descendants(repo, rev, start, limit)
 
     def add_role(self, repo, role, subject):
         """Add a role for the given repository."""
@@ -293,6 +792,7 @@ class RepositoryManager(Component):
         setattr(repo, role_attr,
                 getattr(repo, role_attr) | set([subject]))
         self._update_roles_in_db(repo)
+        self._mark_dirty(repo.id)
 
     def revoke_roles(self, repo, roles):
         """Revoke a list of `role, subject` pairs."""
@@ -304,28 +804,217 @@ class RepositoryManager(Component):
             setattr(repo, role_attr,
                     getattr(repo, role_attr) - set([subject]))
         self._update_roles_in_db(repo)
+        self._mark_dirty(repo.id)
 
-    def update_auth_files(self):
+    def export_roles(self):
+        """Yield `reponame, role, subject` triples for all roles of all
+        managed repositories, ordered by repository name.
+        """
+        metadata = self.managed_metadata
+        for id in sorted(metadata, key=lambda id: metadata[id]['name']):
+            info = metadata[id]
+            for role in self.roles:
+                for subject in sorted(info[role + 's']):
+                    if subject:
+                        yield info['name'], role, subject
+
+    def import_roles(self, roles):
+        """Add the given `reponame, role, subject` triples.
+
+        `roles` may be any iterable and is consumed only once. Only the
+        roles of one repository are held in memory at a time, so the
+        input should be grouped by repository like the output of
+        `export_roles`. A repository that appears in several groups is
+        read back from the database for each of them, which is correct
+        but slower. All new roles are stored within a single
+        transaction, and the auth files of the changed repositories are
+        rewritten once afterwards. Returns the number of changed
+        repositories.
+        """
+        ids = dict((info['name'], id)
+                   for id, info in self.managed_metadata.iteritems())
+        changed = set()
+        with self.env.db_transaction as db:
+            for reponame, rows in groupby(roles, itemgetter(0)):
+                id = ids.get(reponame)
+                if id is None:
+                    raise TracError(_("Repository '%(repo)s' does not exist",
+                                      repo=reponame))
+                current = self._read_roles_from_db(db, id)
+                modified = False
+                for name, role, subject in rows:
+                    assert role in self.roles
+                    if subject not in current[role]:
+                        current[role].add(subject)
+                        modified = True
+                if modified:
+                    self._write_roles_to_db(db, id, current)
+                    changed.add(id)
+            if changed:
+                self._invalidate_metadata()
+        for id in changed:
+            self._mark_dirty(id)
+        self.update_auth_files(incremental=True)
+        return len(changed)
+
+    def check_permissions_changed(self):
+        """Return whether the permissions or the known users changed
+        since the auth files were last rebuilt completely.
+
+        A full rebuild stores a fingerprint of the `permission` table
+        and of the names of all known users in the `system` table once
+        it succeeded, so a failed rebuild is detected again by the next
+        call.
+        """
+        fingerprint = self._get_permissions_fingerprint()
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name = %s
+                """, (db_default.name + '_permissions',)):
+            if value == fingerprint:
+                return False
+        del self.access_index
+        return True
+
+    def update_auth_files(self, incremental=False):
         """Rewrites all configured auth files for all managed
         repositories.
+
+        If `incremental` is true, only the repositories marked dirty by
+        `create`, `fork_local`, `modify`, `add_role` and `revoke_roles`
+        are rewritten, along with their forks that inherit readers.
+
+        Files whose content does not change are not touched. Returns the
+        number of files that were actually written.
+
+        Only one process at a time rewrites the auth files. The request
+        is recorded in a pending file first, and if another process
+        holds the lock, this call returns `None` immediately and the
+        holder handles the request before it releases the lock.
+        Requests whose rebuild fails are recorded again, so the next
+        call retries them.
         """
+        with self._dirty_lock:
+            dirty = self._dirty_repositories
+            self._dirty_repositories = set()
+        self._add_pending_auth_update(dirty, incremental)
+        own = (dirty, incremental)
+
+        changed = None
+        lock_path = os.path.join(self.env.path, self.base_dir, '.auth_lock')
+        self._prepare_base_directory(lock_path)
+        while True:
+            with open(lock_path, 'a') as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError, e:
+                        if e.errno not in (errno.EAGAIN, errno.EACCES):
+                            raise
+                        return changed
+                changed = changed or 0
+                while True:
+                    pending = self._take_pending_auth_update()
+                    if pending is None:
+                        break
+                    dirty, incremental = pending
+                    if not (incremental and own[1] and dirty <= own[0]):
+                        # Other processes handed off their requests, so
+                        # their changes must be visible here
+                        self.refresh()
+                        del self.managed_metadata
+                        del self.access_index
+                    try:
+                        changed += self._write_auth_files(dirty, incremental)
+                    except:
+                        self._add_pending_auth_update(dirty, incremental)
+                        raise
+            # Requests added after the last check but before the lock was
+            # released were given up by their process and are ours
+            if not self._has_pending_auth_update():
+                return changed
+
+    ### Private methods
+    def _get_pending_auth_path(self):
+        return os.path.join(self.env.path, self.base_dir, '.auth_pending')
+
+    def _add_pending_auth_update(self, dirty, incremental):
+        """Record a request for `update_auth_files` in the pending file.
+
+        Every line holds the id of a dirty repository, a `*` stands for
+        a full rebuild.
+        """
+        path = self._get_pending_auth_path()
+        self._prepare_base_directory(path)
+        lines = [str(id) for id in dirty] if incremental else ['*']
+        with open(path, 'a') as pending_file:
+            if fcntl is not None:
+                fcntl.flock(pending_file, fcntl.LOCK_EX)
+            pending_file.write(''.join(line + '\n' for line in lines))
+
+    def _take_pending_auth_update(self):
+        """Return and clear the recorded requests as a `dirty,
+        incremental` pair or `None` if there are none.
+        """
+        path = self._get_pending_auth_path()
+        try:
+            pending_file = open(path, 'r+')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        with pending_file:
+            if fcntl is not None:
+                fcntl.flock(pending_file, fcntl.LOCK_EX)
+            lines = pending_file.read().split()
+            if not lines:
+                return None
+            pending_file.seek(0)
+            pending_file.truncate()
+        if '*' in lines:
+            return set(), False
+        return set(int(line) for line in lines), True
+
+    def _has_pending_auth_update(self):
+        try:
+            return os.path.getsize(self._get_pending_auth_path()) > 0
+        except OSError:
+            return False
+
+    def _write_auth_files(self, dirty, incremental):
+        """Rewrite the auth files for the given set of dirty repository
+        ids or, if `incremental` is false, for all repositories.
+        """
+        if incremental and not dirty <= set(self.managed_metadata):
+            # Unknown ids were removed meanwhile or are not visible yet,
+            # a full rebuild covers both
+            incremental = False
+        if incremental:
+            all_repositories = self._get_affected_repositories(dirty)
+            if not all_repositories:
+                return 0
+        else:
+            fingerprint = self._get_permissions_fingerprint()
+            all_repositories = self._get_all_managed_repositories()
+            del self.access_index
+
+        user_groups = UserGroups(self.env)
+
+        changed = 0
         types = self.get_supported_types()
-        all_repositories = []
-        for repo in self.manager.get_real_repositories():
-            try:
-                convert_managed_repository(self.env, repo)
-                all_repositories.append(repo)
-            except:
-                pass
         for type in types:
             repos = [repo for repo in all_repositories if repo.type == type]
-            self._get_repository_connector(type).update_auth_files(repos)
+            if repos or not incremental:
+                connector = self._get_repository_connector(type)
+                changed += connector.update_auth_files(repos, incremental,
+                                                       user_groups) or 0
 
         authz_source_file = AuthzSourcePolicy(self.env).authz_file
         if authz_source_file:
             authz_source_path = os.path.join(self.env.path, authz_source_file)
 
             authz = ConfigParser()
+            if incremental:
+                authz.read(authz_source_path)
 
             groups = set()
             for repo in all_repositories:
@@ -333,15 +1022,19 @@ class RepositoryManager(Component):
                 groups |= {name for name in repo.writers() if name[0] == '@'}
                 groups |= {name for name in repo.readers() if name[0] == '@'}
 
-            authz.add_section('groups')
+            if not authz.has_section('groups'):
+                authz.add_section('groups')
             for group in groups:
-                members = expand_user_set(self.env, [group])
+                members = user_groups.get_members(group)
                 authz.set('groups', group[1:], ', '.join(sorted(members)))
-            authenticated = sorted({u[0] for u in self.env.get_known_users()})
-            authz.set('groups', 'authenticated', ', '.join(authenticated))
+            if not (incremental and authz.has_option('groups',
+                                                     'authenticated')):
+                authenticated = sorted(user_groups.known_users)
+                authz.set('groups', 'authenticated', ', '.join(authenticated))
 
             for repo in all_repositories:
                 section = repo.reponame + ':/'
+                authz.remove_section(section)
                 authz.add_section(section)
                 r = repo.maintainers() | repo.writers() | repo.readers()
 
@@ -360,15 +1053,47 @@ class RepositoryManager(Component):
                 apply_user_list(r, 'r')
 
             self._prepare_base_directory(authz_source_path)
-            with open(authz_source_path, 'wb') as authz_file:
-                authz.write(authz_file)
-            try:
-                modes = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-                os.chmod(authz_source_path, modes)
-            except:
-                pass
+            changed += write_auth_file(authz_source_path, authz)
+
+        if not incremental:
+            self._store_permissions_fingerprint(fingerprint)
+        return changed
+
+    def _get_schema_version(self, db):
+        """Return the installed version of the plugin's tables or 0."""
+        for value, in db("SELECT value FROM system WHERE name = %s",
+                         (db_default.name,)):
+            return int(value)
+        return 0
+
+    def _get_permissions_fingerprint(self):
+        """Return a hash of everything the auth files depend on
+        besides the managed repositories themselves.
+        """
+        digest = hashlib.sha1()
+        for username, action in self.env.db_query("""
+                SELECT username, action FROM permission
+                ORDER BY username, action"""):
+            digest.update(('%s\0%s\n' % (username, action)).encode('utf-8'))
+        digest.update('\0')
+        for username in sorted(u[0] for u in self.env.get_known_users()):
+            digest.update(username.encode('utf-8') + '\n')
+        return digest.hexdigest()
+
+    def _store_permissions_fingerprint(self, fingerprint):
+        """Remember the fingerprint the auth files were built from."""
+        name = db_default.name + '_permissions'
+        with self.env.db_transaction as db:
+            for value, in db("SELECT value FROM system WHERE name = %s",
+                             (name,)):
+                if value != fingerprint:
+                    db("UPDATE system SET value = %s WHERE name = %s",
+                       (fingerprint, name))
+                break
+            else:
+                db("INSERT INTO system (name, value) VALUES (%s, %s)",
+                   (name, fingerprint))
 
-    ### Private methods
     def _get_repository_connector(self, repo_type):
         """Get the matching connector with maximum priority."""
         return max(((connector, type, prio) for connector in self.connectors
@@ -376,6 +1101,117 @@ class RepositoryManager(Component):
                     if prio >= 0 and type == repo_type),
                    key=lambda x: x[2])[0]
 
+    def _seed_revision_cache(self, db, origin, id):
+        """Copy the cached revisions of `origin` to the repository with
+        the given id.
+
+        A fresh fork contains all changesets of its origin, so the
+        origin's `revision` and `node_change` rows can be copied instead
+        of walking the whole history again. Returns whether the cache
+        was seeded.
+        """
+        rows = db("""SELECT value FROM repository
+                     WHERE id = %s AND name = 'youngest_rev'""", (origin.id,))
+        if not rows or not rows[0][0]:
+            return False
+        db("""INSERT INTO revision (repos, rev, time, author, message)
+              SELECT %s, rev, time, author, message FROM revision
+              WHERE repos = %s""", (id, origin.id))
+        db("""INSERT INTO node_change (repos, rev, path, node_type,
+                                      change_type, base_path, base_rev)
+              SELECT %s, rev, path, node_type, change_type, base_path,
+                     base_rev FROM node_change
+              WHERE repos = %s""", (id, origin.id))
+        db("""INSERT INTO repository (id, name, value)
+              VALUES (%s, 'youngest_rev', %s)""", (id, rows[0][0]))
+        return True
+
+    def _has_cached_youngest(self, repo):
+        """Check that the youngest cached revision of a seeded repository
+        really exists in the repository itself.
+        """
+        for value, in self.env.db_query("""
+                SELECT value FROM repository
+                WHERE id = %s AND name = 'youngest_rev'""", (repo.id,)):
+            backend = getattr(repo, 'repos', repo)
+            rev = repo.rev_db(value) if hasattr(repo, 'rev_db') else value
+            try:
+                backend.get_changeset(rev)
+            except:
+                return False
+            return True
+        return False
+
+    def _move_to_trash(self, repo):
+        """Atomically move the directory of a repository into the trash
+        and return its new location.
+        """
+        trash = os.path.join(self.env.path, self.base_dir, '.trash')
+        path = os.path.join(trash, '%d-%d' % (repo.id, time.time()))
+        self._prepare_base_directory(path)
+        try:
+            os.rename(repo.directory, path)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(repo.directory, path)
+        return path
+
+    def _mark_dirty(self, id):
+        """Remember that the auth information of the given repository
+        must be rewritten by the next incremental `update_auth_files`.
+        """
+        with self._dirty_lock:
+            self._dirty_repositories.add(id)
+
+    def _get_affected_repositories(self, ids):
+        """Return the managed repositories for the given ids along with
+        all their forks that inherit readers.
+        """
+        metadata = self.managed_metadata
+        ids = set(ids)
+        ids |= set(id for id, info in metadata.iteritems()
+                   if info['origin'] in ids and info['inherit_readers'])
+        repositories = []
+        for id in ids:
+            if id not in metadata:
+                continue
+            try:
+                repo = self.get_repository_by_id(id, True)
+            except TracError:
+                continue
+            if repo:
+                repositories.append(repo)
+        return repositories
+
+    def _get_all_managed_repositories(self):
+        """Return all managed repositories converted to
+        `ManagedRepository`.
+        """
+        repositories = []
+        for repo in self.manager.get_real_repositories():
+            try:
+                convert_managed_repository(self.env, repo)
+                repositories.append(repo)
+            except:
+                pass
+        return repositories
+
+    def _get_repository_names_by_id(self):
+        """Return a dictionary of repository names indexed by id.
+
+        The index is rebuilt only if Trac's list of repositories was
+        reloaded since the last call.
+        """
+        repositories = self.manager.get_all_repositories()
+        source, names = self._repository_ids
+        if source is not repositories:
+            names = dict((info['id'], name)
+                         for name, info in repositories.iteritems()
+                         if 'id' in info)
+            self._repository_ids = (repositories, names)
+        return names
+
     def _prepare_base_directory(self, directory):
         """Create the base directories and set the correct modes."""
         base = os.path.dirname(directory)
@@ -391,16 +1227,12 @@ class RepositoryManager(Component):
             os.umask(original_umask)
 
     def _adjust_modes(self, directory):
-        """Set modes 770 and 660 for directories and files."""
+        """Set modes 770 and 660 for directories and files.
+
+        Returns the number of entries that were changed.
+        """
         try:
-            os.chmod(directory, stat.S_IRWXU | stat.S_IRWXG)
-            fmodes = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-            dmodes = stat.S_IRWXU | stat.S_IRWXG
-            for subdir, dirnames, filenames in os.walk(directory):
-                for dirname in dirnames:
-                    os.chmod(os.path.join(subdir, dirname), dmodes)
-                    for filename in filenames:
-                        os.chmod(os.path.join(subdir, filename), fmodes)
+            return adjust_modes(directory, self.adjust_modes_threads)
         except OSError, e:
             raise TracError(_("Failed to adjust file modes: " + str(e)))
 
@@ -410,15 +1242,61 @@ class RepositoryManager(Component):
         for role in self.roles:
             roles[role] = getattr(repo, '_' + role + 's')
         with self.env.db_transaction as db:
-            db.executemany(
-                "UPDATE repository SET value = %s WHERE id = %s AND name = %s",
-                [(','.join(roles[role]), repo.id, role + 's')
-                 for role in self.roles])
+            self._write_roles_to_db(db, repo.id, roles)
+            self._invalidate_metadata()
 
-def convert_managed_repository(env, repo):
-    """Convert a given repository into a `ManagedRepository`."""
+    def _read_roles_from_db(self, db, id):
+        """Return a dict with the set of subjects of each role of the
+        given repository as currently stored in the database.
+        """
+        roles = dict((role, set()) for role in self.roles)
+        for name, value in db("""
+                SELECT name, value FROM repository WHERE id = %s
+                """, (id,)):
+            role = name[:-1]
+            if name.endswith('s') and role in roles and value:
+                roles[role] = set(value.split(','))
+        return roles
+
+    def _write_roles_to_db(self, db, id, roles):
+        """Store the given dict of role subjects of a repository."""
+        db.executemany(
+            "UPDATE repository SET value = %s WHERE id = %s AND name = %s",
+            [(','.join(roles[role]), id, role + 's') for role in self.roles])
+
+    def _invalidate_ancestors(self, repo):
+        """Forget the cached common ancestors of the given repository
+        and of all its forks.
+        """
+        ids = [repo.id] + [id for id, info
+                           in self.managed_metadata.iteritems()
+                           if info['origin'] == repo.id]
+        with self.env.db_transaction as db:
+            db.executemany("DELETE FROM repository_ancestor WHERE repos = %s",
+                           [(id,) for id in ids])
+
+    def _invalidate_metadata(self):
+        """Bump the generation of the cached managed metadata and of
+        the access index derived from it.
+        """
+        del self.managed_metadata
+        del self.access_index
+
+_managed_classes = {}
+_managed_class_bases = {}
+
+def _get_managed_classes(base):
+    """Return the `ManagedRepository` and `ForkedRepository` classes
+    derived from the given repository backend class.
 
-    class ManagedRepository(repo.__class__):
+    The classes are generated once per backend class and reused for
+    all following conversions.
+    """
+    classes = _managed_classes.get(base)
+    if classes is not None:
+        return classes
+
+    class ManagedRepository(base):
         """A repository managed by the new `RepositoryManager`.
 
         This repository class inherits from the original class of the
@@ -438,6 +1316,7 @@ def convert_managed_repository(env, repo):
         is_forkable = False
         directory = None
         _owner_is_maintainer = False
+        _connector = None
         _maintainers = set()
         _writers = set()
         _readers = set()
@@ -453,6 +1332,26 @@ def convert_managed_repository(env, repo):
         def readers(self):
             return self._readers | set([self.owner])
 
+        def get_existing_revisions(self, revs):
+            """Return the set of the given revisions that exist in this
+            repository.
+
+            The connector of the repository type answers this with a
+            batch query. Each revision is looked up on its own only if
+            the connector is not available.
+            """
+            if self._connector is not None:
+                return self._connector.get_existing_revisions(self, revs)
+            existing = set()
+            for rev in revs:
+                try:
+                    self.get_changeset(rev)
+                except:
+                    pass
+                else:
+                    existing.add(rev)
+            return existing
+
     class ForkedRepository(ManagedRepository):
         """A local fork of a `ManagedRepository`.
 
@@ -468,20 +1367,26 @@ def convert_managed_repository(env, repo):
             """Goes back in the repositories history starting from
             `rev` until it finds a revision that also exists in the
             origin of this fork.
-            """
-            nodes = [rev]
-            while len(nodes):
-                node = nodes.pop(0)
-
-                try:
-                    self.origin.get_changeset(node)
-                except:
-                    pass
-                else:
-                    return node
 
-                for ancestor in self.parent_revs(node):
-                    nodes.append(ancestor)
+            The history is traversed breadth-first. Every revision is
+            visited only once and the origin is asked for a whole
+            generation of candidates at a time.
+            """
+            visited = set([rev])
+            candidates = [rev]
+            while candidates:
+                existing = self.origin.get_existing_revisions(candidates)
+                for node in candidates:
+                    if node in existing:
+                        return node
+
+                parents = []
+                for node in candidates:
+                    for ancestor in self.parent_revs(node):
+                        if ancestor not in visited:
+                            visited.add(ancestor)
+                            parents.append(ancestor)
+                candidates = parents
 
             return None
 
@@ -491,79 +1396,278 @@ def convert_managed_repository(env, repo):
                 return readers | self.origin.maintainers()
             return readers
 
-    def _get_role(db, role):
-        """Get the set of users that have the given `role` on this
-        repository.
+    classes = _managed_classes.setdefault(base, (ManagedRepository,
+                                                 ForkedRepository))
+    for cls in classes:
+        _managed_class_bases.setdefault(cls, base)
+    return classes
+
+def convert_managed_repository(env, repo):
+    """Convert a given repository into a `ManagedRepository`.
+
+    Converting a repository that is already up to date with the managed
+    metadata is a no-op.
+    """
+    trac_rm = TracRepositoryManager(env)
+    rm = RepositoryManager(env)
+    info = trac_rm.get_all_repositories().get(repo.reponame)
+    metadata = info and rm.managed_metadata.get(info['id'])
+    if not metadata:
+        raise TracError(_("Not a managed repository"))
+
+    base = _managed_class_bases.get(repo.__class__)
+    if base is not None and repo.__dict__.get('_metadata') is metadata:
+        return
+    ManagedRepository, ForkedRepository = _get_managed_classes(
+        base or repo.__class__)
+
+    repo.__class__ = ManagedRepository
+    repo._metadata = metadata
+    repo.id = info['id']
+    repo.owner = metadata['owner']
+    for role in rm.roles:
+        setattr(repo, '_' + role + 's', set(metadata[role + 's']))
+    repo._owner_is_maintainer = rm.owner_as_maintainer
+
+    repo.type = info['type']
+    repo.description = info.get('description')
+    repo.is_forkable = repo.type in rm.get_forkable_types()
+    try:
+        repo._connector = rm._get_repository_connector(repo.type)
+    except ValueError:
+        repo._connector = None
+    repo.directory = info['dir']
+    repo.is_fork = False
+
+    if not metadata['origin']:
+        return
+
+    repo.__class__ = ForkedRepository
+    repo.is_fork = True
+    repo.origin = rm.get_repository(metadata['origin_name'], True)
+    if repo.origin is None:
+        raise TracError(_("Origin of previously forked repository "
+                          "does not exist anymore"))
+    repo.inherit_readers = metadata['inherit_readers']
+
+_batch_env = None
+
+def _create_repository(repo):
+    """Create a single repository of `RepositoryManager.create_batch`.
+
+    Runs in a worker process that inherited the environment via
+    `_batch_env` and must not touch the database. Returns an error
+    message or `None` on success.
+    """
+    rm = RepositoryManager(_batch_env)
+    try:
+        rm._get_repository_connector(repo['type']).create(repo)
+        adjust_modes(repo['dir'])
+    except Exception, e:
+        return exception_to_unicode(e)
+    return None
+
+_directory_modes = stat.S_IRWXU | stat.S_IRWXG
+_file_modes = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
+
+def _list_entries(directory):
+    """Yield `(path, is_directory, mode)` for the entries of the given
+    directory. Symbolic links are skipped.
+    """
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_symlink():
+                continue
+            mode = entry.stat(follow_symlinks=False).st_mode
+            yield entry.path, stat.S_ISDIR(mode), mode
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            mode = os.lstat(path).st_mode
+            if stat.S_ISLNK(mode):
+                continue
+            yield path, stat.S_ISDIR(mode), mode
+
+def _adjust_entry_mode(path, is_directory, mode):
+    """Change the mode of the given entry if necessary and return
+    whether it was changed.
+    """
+    wanted = _directory_modes if is_directory else _file_modes
+    if stat.S_IMODE(mode) == wanted:
+        return False
+    os.chmod(path, wanted)
+    return True
+
+def _adjust_tree_modes(directory):
+    """Adjust the modes of everything below the given directory."""
+    changed = 0
+    directories = [directory]
+    while directories:
+        for path, is_directory, mode in _list_entries(directories.pop()):
+            changed += _adjust_entry_mode(path, is_directory, mode)
+            if is_directory:
+                directories.append(path)
+    return changed
+
+def adjust_modes(directory, threads=1):
+    """Set modes 770 and 660 for the directories and files of a tree.
+
+    Only entries whose mode differs are changed. With more than one
+    thread, every directory found is put into a queue shared by
+    `threads` threads, so deep trees like the `.hg` or `db` directory of
+    a repository are spread over all of them. Returns the number of
+    entries that were changed.
+    """
+    changed = _adjust_entry_mode(directory, True, os.stat(directory).st_mode)
+    if threads <= 1:
+        return changed + _adjust_tree_modes(directory)
+
+    queue = Queue()
+    counts = []
+    errors = []
+
+    def work():
+        count = 0
+        while True:
+            path = queue.get()
+            try:
+                if path is None:
+                    break
+                if errors:
+                    continue
+                for entry, is_directory, mode in _list_entries(path):
+                    count += _adjust_entry_mode(entry, is_directory, mode)
+                    if is_directory:
+                        queue.put(entry)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                queue.task_done()
+        counts.append(count)
+
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    queue.put(directory)
+    queue.join()
+    for worker in workers:
+        queue.put(None)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return changed + sum(counts)
+
+def write_auth_file(path, config, modes=_file_modes):
+    """Atomically replace `path` with the rendered `config`.
+
+    The file is rendered to memory first and left untouched if its
+    content would not change. Otherwise the content is written to a
+    temporary file in the same directory, which gets `modes` applied
+    before being renamed over `path`, so readers like Apache never see
+    a partially written file. Returns whether the file was changed.
+    """
+    buf = StringIO()
+    config.write(buf)
+    content = buf.getvalue()
+
+    try:
+        with open(path, 'rb') as current:
+            if hashlib.sha1(current.read()).digest() == \
+                    hashlib.sha1(content).digest():
+                return False
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix='.' + name + '.', dir=directory)
+    try:
+        try:
+            os.fchmod(fd, modes)
+        except OSError:
+            pass
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(content)
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+class UserGroups(object):
+    """Resolved memberships of all permission groups.
+
+    The permissions and known users are fetched once on creation. The
+    transitive members of each group are computed on first use and
+    memoized, so that expanding user sets for many repositories does
+    not scan the permissions again. Cyclic group definitions are
+    detected and resolved to the union of all groups in the cycle.
+    """
+
+    special_users = frozenset(['anonymous', 'authenticated'])
+
+    def __init__(self, env):
+        all_permissions = PermissionSystem(env).get_all_permissions()
+
+        self.known_users = frozenset(u[0] for u in env.get_known_users())
+        valid_users = ({perm[0] for perm in all_permissions} &
+                       (self.known_users | self.special_users))
+
+        self._users = {}
+        self._subgroups = {}
+        for subject, action in all_permissions:
+            group = '@' + action
+            if subject in valid_users:
+                self._users.setdefault(group, set()).add(subject)
+            else:
+                self._subgroups.setdefault(group, set()).add('@' + subject)
+        self._members = {}
+
+    def get_members(self, group):
+        """Return the set of users that are transitively members of the
+        given group (including the leading '@').
         """
-        result = db("""SELECT value FROM repository
-                       WHERE name = '%s' AND id = %d
-                       """ % (role + 's', repo.id))[0][0]
-        if result:
-            return set(result.split(','))
-        return set()
-
-    if repo.__class__ is not ManagedRepository:
-        trac_rm = TracRepositoryManager(env)
-        repo.id = trac_rm.get_repository_id(repo.reponame)
-        rm = RepositoryManager(env)
-        with env.db_transaction as db:
-            result = db("""SELECT value FROM repository
-                           WHERE name = 'owner' AND id = %d
-                           """ % repo.id)
-            if not result:
-                raise TracError(_("Not a managed repository"))
-
-            repo.__class__ = ManagedRepository
-            repo.owner = result[0][0]
-            for role in rm.roles:
-                role_attr = '_' + role + 's'
-                setattr(repo, role_attr,
-                        getattr(repo, role_attr) | _get_role(db, role))
-        repo._owner_is_maintainer = rm.owner_as_maintainer
-
-        info = trac_rm.get_all_repositories().get(repo.reponame)
-        repo.type = info['type']
-        repo.description = info.get('description')
-        repo.is_forkable = repo.type in rm .get_forkable_types()
-        repo.directory = info['dir']
-
-        with env.db_transaction as db:
-            result = db("""SELECT value FROM repository
-                           WHERE name = 'name' AND
-                                 id = (SELECT value FROM repository
-                                       WHERE name = 'origin' AND id = %d)
-                           """ % repo.id)
-            if not result:
-                return
-
-            repo.__class__ = ForkedRepository
-            repo.is_fork = True
-            repo.origin = rm.get_repository(result[0][0], True)
-            if repo.origin is None:
-                raise TracError(_("Origin of previously forked repository "
-                                  "does not exist anymore"))
-            result = db("""SELECT value FROM repository
-                           WHERE name = 'inherit_readers' AND id = %d
-                           """ % repo.id)
-            repo.inherit_readers = as_bool(result[0][0])
-
-def expand_user_set(env, users):
-    """Replaces all groups by their users until only users are left."""
-    all_permissions = PermissionSystem(env).get_all_permissions()
-
-    special_users = set(['anonymous', 'authenticated'])
-    known_users = {u[0] for u in env.get_known_users()} | special_users
-    valid_users = {perm[0] for perm in all_permissions} & known_users
-
-    groups = set()
-    user_list = list(users)
-    for name in user_list:
-        if name[0] == '@':
-            groups |= set([name])
-            for perm in (perm for perm in all_permissions
-                         if perm[1] == name[1:]):
-                if perm[0] in valid_users:
-                    user_list.append(perm[0])
-                elif not perm[0] in groups:
-                    user_list.append('@' + perm[0])
-    return set(user_list) - groups
+        members = self._members.get(group)
+        if members is None:
+            members = set()
+            visited = set([group])
+            pending = [group]
+            while pending:
+                name = pending.pop()
+                resolved = self._members.get(name)
+                if resolved is not None:
+                    members |= resolved
+                    continue
+                members |= self._users.get(name, set())
+                for subgroup in self._subgroups.get(name, ()):
+                    if subgroup not in visited:
+                        visited.add(subgroup)
+                        pending.append(subgroup)
+            members = frozenset(members)
+            self._members[group] = members
+        return members
+
+    def expand(self, users):
+        """Replaces all groups by their users until only users are left."""
+        result = set()
+        for name in users:
+            if name[0] == '@':
+                result |= self.get_members(name)
+            else:
+                result.add(name)
+        return result
+
+def expand_user_set(env, users, groups=None):
+    """Replaces all groups by their users until only users are left.
+
+    Pass a `UserGroups` instance as `groups` to avoid resolving the
+    group memberships again for every call.
+    """
+    if groups is None:
+        groups = UserGroups(env)
+    return groups.expand(users)
@@ -0,0 +1,80 @@
+from trac.db import Table, Column, Index
+
+name = 'repository_manager'
+version = 3
+
+def get_upgrades():
+    """Return the tables introduced by each schema version."""
+    return {
+        1: [
+            Table('repository_ancestor', key=('repos', 'rev'))[
+                Column('repos', type='int'),
+                Column('rev'),
+                Column('origin_rev'),
+                Column('ancestor')],
+        ],
+        2: [
+            Table('repository_job', key='id')[
+                Column('id', auto_increment=True),
+                Column('action'),
+                Column('reponame'),
+                Column('args'),
+                Column('submitter'),
+                Column('status'),
+                Column('progress'),
+                Column('message'),
+                Column('time', type='int64'),
+                Column('changetime', type='int64'),
+                Index(['status']),
+                Index(['reponame'])],
+        ],
+        3: [
+            Table('pull_request', key='ticket')[
+                Column('ticket', type='int'),
+                Column('srcrepo', type='int'),
+                Column('srcrev'),
+                Column('dstrepo', type='int'),
+                Column('dstrev'),
+                Column('status'),
+                Column('merged', type='int'),
+                Column('dstyoungest'),
+                Index(['srcrepo', 'status']),
+                Index(['dstrepo', 'status']),
+                Index(['dstrepo', 'srcrev']),
+                Index(['merged'])],
+            backfill_pull_requests,
+        ],
+    }
+
+def backfill_pull_requests(env, db):
+    """Add the existing pull request tickets to the `pull_request` table.
+
+    Their merged state is left unknown (`NULL`) and determined the
+    next time it is needed, which also normalizes the source revision
+    through the source repository.
+    """
+    tickets = dict((id, {'status': status}) for id, status in db("""
+        SELECT id, status FROM ticket WHERE type = 'pull request'"""))
+    for id, name, value in db("""
+            SELECT ticket, name, value FROM ticket_custom
+            WHERE name IN ('pr_srcrepo', 'pr_srcrev', 'pr_dstrepo',
+                           'pr_dstrev')"""):
+        if id in tickets:
+            tickets[id][name] = value
+
+    values = []
+    for id, fields in tickets.iteritems():
+        try:
+            srcrepo = int(fields.get('pr_srcrepo'))
+            dstrepo = int(fields.get('pr_dstrepo'))
+        except (TypeError, ValueError):
+            continue
+        values.append((id, srcrepo, fields.get('pr_srcrev') or '', dstrepo,
+                       fields.get('pr_dstrev') or '', fields['status']))
+    if values:
+        cursor = db.cursor()
+        cursor.executemany("""
+            INSERT INTO pull_request (ticket, srcrepo, srcrev, dstrepo,
+                                      dstrev, status, merged)
+            VALUES (%s, %s, %s, %s, %s, %s, NULL)
+            """, values)
@@ -0,0 +1,280 @@
+from api import *
+
+from trac.core import *
+from trac.config import ChoiceOption, IntOption
+from trac.util.datefmt import to_utimestamp, from_utimestamp, utc
+from trac.util.text import exception_to_unicode
+
+from datetime import datetime
+
+import json
+import threading
+import time
+
+class RepositoryJobQueue(Component):
+    """Executes long running repository operations in the background.
+
+    Creating and forking repositories, purging removed ones or rewriting
+    all auth files may take a long time for large installations.
+    Instead of doing that work inside the web request, jobs are stored
+    in the `repository_job` table and executed by a worker thread of the
+    web server process or by a separate `trac-admin repository
+    job_worker` daemon.
+
+    Submitting an operation for a repository that already has the same
+    operation queued or running returns the existing job. Purges and
+    rebuilds of the auth files are only merged with jobs that did not
+    start yet, as a running one may miss the changes that caused the
+    submission.
+    """
+
+    worker = ChoiceOption('repository-manager', 'job_worker',
+                          ['inprocess', 'daemon', 'request'],
+                          doc="""Where queued repository operations are
+                                 executed: `inprocess` starts a background
+                                 thread in the web server process, `daemon`
+                                 leaves them to `trac-admin repository
+                                 job_worker` and `request` executes them
+                                 immediately within the submitting request.
+                                 """)
+
+    stale_timeout = IntOption('repository-manager', 'job_stale_timeout',
+                              6 * 3600,
+                              doc="""Seconds after which a running
+                                     repository operation that did not
+                                     report any progress is considered
+                                     aborted, e.g. because its worker
+                                     process was killed. It is marked as
+                                     failed and can be submitted again.
+                                     """)
+
+    actions = ('create', 'fork_local', 'purge_removed', 'update_auth_files')
+
+    active_states = ('queued', 'running')
+
+    def __init__(self):
+        self._worker_thread = None
+        self._worker_lock = threading.Lock()
+
+    def submit(self, action, reponame, args, submitter):
+        """Queue the `RepositoryManager` method `action` for the given
+        repository and return the job id.
+
+        `args` must be serializable as JSON.
+        """
+        assert action in self.actions
+        # A running purge or auth rebuild might miss the changes that
+        # caused this submission, so it only absorbs queued jobs
+        states = self.active_states
+        if action in ('purge_removed', 'update_auth_files'):
+            states = ('queued',)
+        self._fail_stale_jobs()
+        with self.env.db_transaction as db:
+            for id, in db("""
+                    SELECT id FROM repository_job
+                    WHERE action = %%s AND reponame = %%s AND status IN (%s)
+                    """ % ', '.join(['%s'] * len(states)),
+                    (action, reponame) + states):
+                return id
+            now = to_utimestamp(datetime.now(utc))
+            cursor = db.cursor()
+            cursor.execute("""
+                INSERT INTO repository_job (action, reponame, args, submitter,
+                                            status, progress, message, time,
+                                            changetime)
+                VALUES (%s, %s, %s, %s, 'queued', '', '', %s, %s)
+                """, (action, reponame, json.dumps(args), submitter, now, now))
+            id = db.get_last_id(cursor, 'repository_job')
+
+        if self.worker == 'request':
+            job = self._claim_job(id)
+            if job is not None:
+                self._execute(job)
+        elif self.worker == 'inprocess':
+            self._start_worker()
+        return id
+
+    def get_job(self, id):
+        """Return a dictionary describing the given job or `None`."""
+        for row in self.env.db_query("""
+                SELECT id, action, reponame, args, submitter, status,
+                       progress, message, time, changetime
+                FROM repository_job WHERE id = %s
+                """, (id,)):
+            return self._make_job(row)
+        return None
+
+    def get_jobs(self, submitter=None, limit=20):
+        """Return the most recent jobs, optionally only those of the given
+        submitter.
+        """
+        query = """SELECT id, action, reponame, args, submitter, status,
+                          progress, message, time, changetime
+                   FROM repository_job"""
+        args = ()
+        if submitter is not None:
+            query += " WHERE submitter = %s"
+            args = (submitter,)
+        query += " ORDER BY id DESC LIMIT %d" % limit
+        return [self._make_job(row) for row in self.env.db_query(query, args)]
+
+    def run_pending(self):
+        """Execute queued jobs until there are none left.
+
+        Returns the number of executed jobs.
+        """
+        count = 0
+        self._fail_stale_jobs()
+        while True:
+            job = self._claim_next_job()
+            if job is None:
+                return count
+            self._execute(job)
+            count += 1
+
+    def run_worker(self, interval=5):
+        """Execute queued jobs forever, polling every `interval`
+        seconds.
+        """
+        while True:
+            if not self.run_pending():
+                time.sleep(interval)
+
+    ### Private methods
+    def _make_job(self, row):
+        (id, action, reponame, args, submitter, status, progress, message,
+         created, changetime) = row
+        return {'id': id,
+                'action': action,
+                'reponame': reponame,
+                'args': json.loads(args),
+                'submitter': submitter,
+                'status': status,
+                'progress': progress,
+                'message': message,
+                'time': from_utimestamp(created),
+                'changetime': from_utimestamp(changetime)}
+
+    def _start_worker(self):
+        """Start the background thread of this process if it is not
+        already running.
+        """
+        with self._worker_lock:
+            if self._worker_thread and self._worker_thread.is_alive():
+                return
+            thread = threading.Thread(target=self._run_worker_thread,
+                                      name='RepositoryJobQueue')
+            thread.daemon = True
+            thread.start()
+            self._worker_thread = thread
+
+    def _run_worker_thread(self):
+        """Body of the background thread started by `_start_worker`."""
+        while True:
+            self.run_pending()
+            with self._worker_lock:
+                if not self._has_queued_jobs():
+                    self._worker_thread = None
+                    return
+
+    def _has_queued_jobs(self):
+        """Return whether there are jobs waiting for execution."""
+        return bool(self.env.db_query("""
+            SELECT id FROM repository_job WHERE status = 'queued' LIMIT 1
+            """))
+
+    def _claim_next_job(self):
+        """Atomically mark the oldest queued job as running and return
+        it. Returns `None` if there is no queued job.
+        """
+        while True:
+            rows = self.env.db_query("""
+                SELECT id FROM repository_job
+                WHERE status = 'queued' ORDER BY id LIMIT 1
+                """)
+            if not rows:
+                return None
+            job = self._claim_job(rows[0][0])
+            if job is not None:
+                return job
+
+    def _claim_job(self, id):
+        """Atomically mark the given queued job as running and return
+        it. Returns `None` if the job is not queued (anymore).
+        """
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE repository_job SET status = 'running', changetime = %s
+                WHERE id = %s AND status = 'queued'
+                """, (to_utimestamp(datetime.now(utc)), id))
+            claimed = cursor.rowcount == 1
+        return self.get_job(id) if claimed else None
+
+    def _fail_stale_jobs(self):
+        """Mark running jobs that did not report progress for
+        `job_stale_timeout` seconds as failed.
+
+        Their worker is assumed to be gone, so new submissions for the
+        same repository must not be merged into them.
+        """
+        now = datetime.now(utc)
+        limit = to_utimestamp(now) - self.stale_timeout * 1000000
+        with self.env.db_transaction as db:
+            for id, action, reponame in db("""
+                    SELECT id, action, reponame FROM repository_job
+                    WHERE status = 'running' AND changetime < %s
+                    """, (limit,)):
+                self.log.warning("Repository job %d (%s %s) did not report "
+                                 "progress for %d seconds, marking it as "
+                                 "failed", id, action, reponame,
+                                 self.stale_timeout)
+            db("""UPDATE repository_job
+                  SET status = 'failed', progress = '', changetime = %s,
+                      message = 'The worker executing the job stopped.'
+                  WHERE status = 'running' AND changetime < %s
+                  """, (to_utimestamp(now), limit))
+
+    def _execute(self, job):
+        """Execute the given job and record its outcome."""
+        def progress(message):
+            self._update(job['id'], progress=message)
+
+        self._refresh()
+        rm = RepositoryManager(self.env)
+        args = job['args']
+        try:
+            if job['action'] == 'purge_removed':
+                rm.purge_removed(progress)
+            elif job['action'] == 'update_auth_files':
+                rm.update_auth_files()
+            else:
+                getattr(rm, job['action'])(args, progress)
+        except Exception, e:
+            self.log.error("Repository job %d (%s %s) failed: %s", job['id'],
+                           job['action'], job['reponame'],
+                           exception_to_unicode(e, traceback=True))
+            self._update(job['id'], status='failed', progress='',
+                         message=exception_to_unicode(e))
+        else:
+            self._update(job['id'], status='done', progress='')
+
+    def _refresh(self):
+        """Pick up changes made by other processes since the last job.
+
+        A worker lives much longer than a request, so like Trac does at
+        the start of every request, the configuration is reparsed if it
+        changed, cached values are validated again and the list of
+        repositories is reloaded.
+        """
+        self.env.config.parse_if_needed()
+        RepositoryManager(self.env).refresh()
+
+    def _update(self, id, **values):
+        """Update the given columns of a job."""
+        values['changetime'] = to_utimestamp(datetime.now(utc))
+        names = sorted(values)
+        with self.env.db_transaction as db:
+            db("UPDATE repository_job SET %s WHERE id = %%s"
+               % ', '.join(name + ' = %s' for name in names),
+               [values[name] for name in names] + [id])
@@ -0,0 +1,50 @@
+from api import *
+
+from trac.core import *
+from trac.perm import IPermissionPolicy
+
+class RepositoryAccessPolicy(Component):
+    """Grant read access to managed repositories based on their roles.
+
+    Answers the checks for browsing a managed repository from the
+    in-memory index of `RepositoryManager` instead of parsing the authz
+    file written for `AuthzSourcePolicy`. Checks without a resource and
+    checks for repositories that are not managed are left to the other
+    policies.
+
+    To activate it, add `RepositoryAccessPolicy` in front of
+    `DefaultPermissionPolicy` to the list of `permission_policies` in
+    the [trac] section and remove `AuthzSourcePolicy`.
+    """
+
+    implements(IPermissionPolicy)
+
+    handled_actions = frozenset(['BROWSER_VIEW', 'CHANGESET_VIEW',
+                                 'FILE_VIEW', 'LOG_VIEW'])
+
+    handled_realms = frozenset(['repository', 'source', 'changeset'])
+
+    ### IPermissionPolicy methods
+    def check_permission(self, action, username, resource, perm):
+        if action not in self.handled_actions:
+            return None
+
+        # Global checks stay with the other policies, so revoking the
+        # actions still hides the browser and the timeline
+        reponame = self._get_reponame(resource)
+        if reponame is None:
+            return None
+        return RepositoryManager(self.env).can_read(username, reponame)
+
+    ### Private methods
+    def _get_reponame(self, resource):
+        """Return the name of the repository the given resource belongs
+        to or `None`.
+        """
+        while resource is not None:
+            if resource.realm not in self.handled_realms:
+                return None
+            if resource.realm == 'repository':
+                return resource.id or ''
+            resource = resource.parent
+        return None
@@ -1,8 +1,11 @@
 from ..api import *
 
 from trac.core import implements, Component
-from trac.ticket.api import TicketSystem, ITicketActionController
+from trac.ticket.api import TicketSystem, ITicketActionController, \
+                           ITicketChangeListener
 from trac.ticket.model import Resolution
+from trac.versioncontrol.api import IRepositoryChangeListener, \
+                                    NoSuchChangeset
 from trac.util.translation import _, tag_
 from trac.config import OrderedExtensionsOption
 
@@ -43,8 +46,9 @@ class PullRequestWorkflowProxy(Component):
             return chain.from_iterable(items)
 
         rm = RepositoryManager(self.env)
-        repo = rm.get_repository_by_id(ticket['pr_dstrepo'], True)
-        srcrepo = rm.get_repository_by_id(ticket['pr_srcrepo'], True)
+        repo, srcrepo = rm.get_repositories_by_ids((ticket['pr_dstrepo'],
+                                                    ticket['pr_srcrepo']),
+                                                   True)
 
         current_status = ticket._old.get('status', ticket['status']) or 'new'
         current_owner = ticket._old.get('owner', ticket['owner'])
@@ -90,15 +94,17 @@ class PullRequestWorkflowProxy(Component):
             else:
                 hints.append(_("The ticket will remain with no owner",
                                owner=current_owner))
+        merged = PullRequestMergeTracker(self.env).is_merged(ticket.id, repo,
+                                                             ticket['pr_srcrev'])
         if action == 'accept':
-            if repo.has_node('', ticket['pr_srcrev']):
+            if merged:
                 hints.append(_("The request will be accepted"))
                 hints.append(_("Next status will be '%(name)s'", name='closed'))
             else:
                 hints.append(_("The changes must be merged into '%(repo)s' "
                                "first", repo=repo.reponame))
         if action == 'reject':
-            if not repo.has_node('', ticket['pr_srcrev']):
+            if not merged:
                 hints.append(_("The request will be rejected"))
                 hints.append(_("Next status will be '%(name)s'", name='closed'))
             else:
@@ -184,3 +190,145 @@ class PullRequestWorkflowProxy(Component):
 
             yield ('resolve', tag_('as %(resolution)s', resolution=control),
                    item[2])
+
+
+class PullRequestMergeTracker(Component):
+    """Keeps the `pull_request` table in sync with the pull request
+    tickets and records whether their source revision reached the
+    destination repository.
+
+    Ticket changes update the repositories, revisions and status of a
+    pull request, so looking up the pull requests of a repository is a
+    single indexed query. New changesets synced into a managed
+    repository mark the pull requests they complete as merged, so
+    ticket views read a stored flag instead of asking the version
+    control system. As the sync hooks may not be installed, a flag
+    that is not set is only trusted as long as the youngest revision of
+    the destination stays the same.
+
+    Source revisions are always stored as normalized by the source
+    repository.
+    """
+
+    implements(ITicketChangeListener, IRepositoryChangeListener)
+
+    def is_merged(self, id, srcrepo, dstrepo, srcrev):
+        """Return whether `srcrev` of the pull request ticket `id` from
+        `srcrepo` is present in its destination repository `dstrepo`.
+
+        The stored flag is used if it is known for `srcrev` and, unless
+        it is set, the destination did not change since it was stored.
+        Otherwise `dstrepo` is asked and the result is stored.
+        """
+        srcrev = self._normalize_rev(srcrepo, srcrev)
+        youngest = unicode(dstrepo.get_youngest_rev())
+        if id:
+            for stored_rev, merged, dstyoungest in self.env.db_query("""
+                    SELECT srcrev, merged, dstyoungest FROM pull_request
+                    WHERE ticket = %s""", (id,)):
+                if stored_rev != srcrev and \
+                        self._normalize_rev(srcrepo, stored_rev) != srcrev:
+                    id = None
+                elif merged or (merged is not None and
+                                dstyoungest == youngest):
+                    return bool(merged)
+
+        merged = bool(dstrepo.get_existing_revisions([srcrev]))
+        if id:
+            with self.env.db_transaction as db:
+                db("""UPDATE pull_request
+                      SET srcrev = %s, merged = %s, dstyoungest = %s
+                      WHERE ticket = %s""",
+                   (srcrev, int(merged), youngest, id))
+        return merged
+
+    ### ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        if ticket['type'] == 'pull request':
+            self._update(ticket)
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        old_type = old_values.get('type', ticket['type'])
+        if 'pull request' in (ticket['type'], old_type):
+            self._update(ticket)
+
+    def ticket_deleted(self, ticket):
+        if ticket['type'] == 'pull request':
+            self._remove(ticket)
+
+    ### IRepositoryChangeListener methods
+    def changeset_added(self, repos, changeset):
+        """Mark the pull requests into `repos` that wait for `changeset`
+        as merged.
+        """
+        with self.env.db_transaction as db:
+            db("""UPDATE pull_request SET merged = 1
+                  WHERE dstrepo = %s AND srcrev = %s
+                  AND (merged IS NULL OR merged = 0)""",
+               (repos.id, unicode(changeset.rev)))
+
+    def changeset_modified(self, repos, changeset, old_changeset):
+        pass
+
+    ### Private methods
+    def _normalize_rev(self, srcrepo, rev):
+        """Return the form of `rev` under which it is stored, normalized
+        by the source repository `srcrepo` so that it can be compared
+        with the revisions of synced changesets.
+        """
+        if not (srcrepo and rev):
+            return rev or ''
+        try:
+            return unicode(srcrepo.normalize_rev(rev))
+        except NoSuchChangeset:
+            return rev
+
+    def _remove(self, ticket):
+        """Forget the given ticket."""
+        with self.env.db_transaction as db:
+            db("DELETE FROM pull_request WHERE ticket = %s", (ticket.id,))
+
+    def _update(self, ticket):
+        """Store the fields of a pull request ticket and determine its
+        merged state if the destination or source revision changed.
+        """
+        if ticket['type'] != 'pull request':
+            self._remove(ticket)
+            return
+
+        rm = RepositoryManager(self.env)
+        try:
+            srcrepo_id = int(ticket['pr_srcrepo'])
+            dstrepo_id = int(ticket['pr_dstrepo'])
+        except (TypeError, ValueError):
+            self._remove(ticket)
+            return
+        srcrepo, dstrepo = rm.get_repositories_by_ids((srcrepo_id,
+                                                       dstrepo_id), True)
+        srcrev = self._normalize_rev(srcrepo, ticket['pr_srcrev'])
+
+        rows = self.env.db_query("""
+            SELECT dstrepo, srcrev, merged, dstyoungest FROM pull_request
+            WHERE ticket = %s""", (ticket.id,))
+        if rows and tuple(rows[0][:2]) == (dstrepo_id, srcrev):
+            merged, dstyoungest = rows[0][2:]
+        else:
+            merged = dstyoungest = None
+            if dstrepo and srcrev:
+                dstyoungest = unicode(dstrepo.get_youngest_rev())
+                merged = int(bool(dstrepo.get_existing_revisions([srcrev])))
+
+        values = (srcrepo_id, srcrev, dstrepo_id, ticket['pr_dstrev'] or '',
+                  ticket['status'], merged, dstyoungest, ticket.id)
+        with self.env.db_transaction as db:
+            if rows:
+                db("""UPDATE pull_request SET srcrepo = %s, srcrev = %s,
+                                              dstrepo = %s, dstrev = %s,
+                                              status = %s, merged = %s,
+                                              dstyoungest = %s
+                      WHERE ticket = %s""", values)
+            else:
+                db("""INSERT INTO pull_request (srcrepo, srcrev, dstrepo,
+                                                dstrev, status, merged,
+                                                dstyoungest, ticket)
+                      VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""", values)
@@ -0,0 +1,105 @@
+from trac.core import *
+from trac.config import Option, IntOption
+
+import errno
+import hashlib
+import os
+import tempfile
+
+class DiffCache(Component):
+    """Keeps rendered pull request diffs on disk.
+
+    Entries are plain files named by the hash of their key, so all
+    processes of a multi-process web server share them. The least
+    recently used entries are removed whenever the total size exceeds
+    `pr_diff_cache_size` bytes.
+    """
+
+    cache_dir = Option('repository-manager', 'pr_diff_cache_dir',
+                       'cache/pullrequests',
+                       doc="""Directory, relative to the environment,
+                              where rendered pull request diffs are
+                              cached.
+                              """)
+    cache_size = IntOption('repository-manager', 'pr_diff_cache_size',
+                           64 * 1024 * 1024,
+                           doc="""Maximum number of bytes used by the
+                                  cache of rendered pull request diffs. Set
+                                  to 0 to disable the cache.
+                                  """)
+
+    def make_key(self, *parts):
+        """Return a cache key for the given values."""
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def get(self, key):
+        """Return the cached content for `key` or `None`."""
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as entry:
+                content = entry.read()
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return content.decode('utf-8')
+
+    def put(self, key, content):
+        """Store `content` for `key` and evict old entries if the cache
+        grew too large.
+        """
+        content = content.encode('utf-8')
+        if len(content) > self.cache_size:
+            return
+        directory = os.path.join(self.env.path, self.cache_dir)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp_path = tempfile.mkstemp(prefix='.', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(content)
+            os.rename(temp_path, self._get_path(key))
+        except:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        self._evict(directory)
+
+    ### Private methods
+    def _get_path(self, key):
+        return os.path.join(self.env.path, self.cache_dir, key)
+
+    def _evict(self, directory):
+        """Remove the least recently used entries until the cache fits
+        into its budget.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.cache_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
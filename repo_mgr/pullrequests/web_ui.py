@@ -1,22 +1,30 @@
 from ..api import *
 
 from api import *
+from cache import DiffCache
 
 from trac.core import *
 from trac.web import IRequestHandler, IRequestFilter
-from trac.web.chrome import ITemplateProvider, add_ctxtnav, add_notice, \
-                            add_warning, add_script, add_stylesheet
+from trac.web.chrome import Chrome, ITemplateProvider, add_ctxtnav, \
+                            add_notice, add_warning, add_script, \
+                            add_stylesheet
 from trac.versioncontrol.web_ui import ChangesetModule
-from trac.versioncontrol.diff import get_diff_options
+from trac.versioncontrol.diff import diff_blocks, get_diff_options
+from trac.mimeview.api import Mimeview, is_binary
 from trac.resource import ResourceNotFound
 from trac.ticket.web_ui import TicketModule
 from trac.ticket.api import ITicketManipulator
-from trac.ticket.model import Type, Resolution
+from trac.ticket.model import Ticket, Type, Resolution
 from trac.util.translation import _
-from trac.config import Option
+from trac.config import Option, IntOption
+
+from genshi.core import Markup
+
+from collections import OrderedDict
 
 import os
 import re
+import threading
 
 class PullrequestModule(Component):
     """Provide special ticket type: pull request.
@@ -52,6 +60,25 @@ class PullrequestModule(Component):
     cf_dstrev = Option('ticket-custom', 'pr_dstrev.label',
                        'Destination Revision')
 
+    srcrev_list_size = IntOption('repository-manager', 'pr_srcrev_list_size',
+                                 20,
+                                 doc="""Maximum number of newer source
+                                        revisions offered at once for an
+                                        open pull request.
+                                        """)
+
+    lazy_diff_threshold = IntOption('repository-manager',
+                                    'pr_lazy_diff_threshold', 100,
+                                    doc="""Pull requests changing more
+                                           than this number of files only
+                                           show the list of files at first
+                                           and load the diff of each file
+                                           on demand. Set to 0 to always
+                                           render the whole diff.
+                                           """)
+
+    srcrev_cache_size = 256
+
     def __init__(self):
         """Setup the special ticket type.
 
@@ -61,6 +88,10 @@ class PullrequestModule(Component):
 
         The same way, two new resolutions are added.
         """
+        self._srcrev_lists = OrderedDict()
+        self._ahead_behind = OrderedDict()
+        self._srcrev_lock = threading.Lock()
+
         try:
             item = Type(self.env, 'pull request')
         except ResourceNotFound:
@@ -92,9 +123,14 @@ class PullrequestModule(Component):
             print(req.path_info)
             if req.args['field_type'] == 'pull request':
                 rm = RepositoryManager(self.env)
-                repo = rm.get_repository_by_id(req.args['field_pr_dstrepo'])
+                srcrepo, repo = rm.get_repositories_by_ids(
+                    (req.args['field_pr_srcrepo'],
+                     req.args['field_pr_dstrepo']), True)
                 assert repo
-                rev_in_repo = repo.has_node('', req.args['field_pr_srcrev'])
+                srcrev = req.args['field_pr_srcrev']
+                tracker = PullRequestMergeTracker(self.env)
+                rev_in_repo = tracker.is_merged(int(req.args['id']), srcrepo,
+                                                repo, srcrev)
 
                 if req.args['action'] == 'accept' and not rev_in_repo:
                     add_warning(req, tag_('The changes are not merged into '
@@ -142,7 +178,9 @@ class PullrequestModule(Component):
                 else:
                     self._post_process_newticket_request(req, data)
 
-                self._render_diff_html(req, data)
+                preview = template in ('ticket_box.html',
+                                       'ticket_preview.html')
+                self._render_diff_html(req, data, preview)
                 add_script(req, 'common/js/diff.js')
                 add_stylesheet(req, 'common/css/diff.css')
                 add_stylesheet(req, 'common/css/code.css')
@@ -159,11 +197,18 @@ class PullrequestModule(Component):
 
     ### IRequestHandler methods
     def match_request(self, req):
-        """Creating new pull requests needs a dedicated handler."""
+        """Creating new pull requests needs a dedicated handler, as
+        well as loading the diff of a single file on demand.
+        """
         match = re.match(r'^/newpullrequest(/.+)$', req.path_info)
         if match:
             req.args['path'] = match.group(1)
             return True
+        match = re.match(r'^/ticket/([0-9]+)/diff$', req.path_info)
+        if match:
+            req.args['id'] = match.group(1)
+            req.args['pr_diff'] = '1'
+            return True
 
     def process_request(self, req):
         """Creating a new pull request ticket needs some pre- and post-
@@ -177,15 +222,37 @@ class PullrequestModule(Component):
 
          * Add the repository as is must be looked up via the used path
            and is not yet known to the ticket.
+
+        Requests for the diff of a single file (`diff_old_path` and
+        `diff_new_path`) of a new or
+        existing pull request are answered directly.
         """
+        rm = RepositoryManager(self.env)
+        if req.args.get('pr_diff'):
+            ticket = Ticket(self.env, req.args['id'])
+            req.perm(ticket.resource).require('TICKET_VIEW')
+            if ticket['type'] != 'pull request':
+                raise TracError(_("Ticket is not a pull request."))
+            srcrepo, dstrepo = rm.get_repositories_by_ids(
+                (ticket['pr_srcrepo'], ticket['pr_dstrepo']), True)
+            self._process_diff_request(req, srcrepo or dstrepo,
+                                       ticket['pr_dstrev'],
+                                       ticket['pr_srcrev'])
+
         req.perm.require('TICKET_CREATE')
 
-        rm = RepositoryManager(self.env)
         reponame, repo, path = rm.get_repository_by_path(req.args.get('path'))
-        convert_managed_repository(self.env, repo)
-        if not repo.is_fork:
+        repo = repo and rm.get_request_repository(req, reponame)
+        if not repo or not repo.is_fork:
             raise TracError(_("Repository is not a fork."))
 
+        if req.args.get('diff_old_path') or req.args.get('diff_new_path'):
+            srcrev = req.args.get('pr_srcrev') or repo.get_youngest_rev()
+            self._process_diff_request(req, repo,
+                                       rm.get_youngest_common_ancestor(repo,
+                                                                       srcrev),
+                                       srcrev)
+
         req.args['type'] = 'pull request'
         req.args['pr_srcrev'] = req.args.get('pr_srcrev',
                                              repo.get_youngest_rev())
@@ -219,6 +286,9 @@ class PullrequestModule(Component):
          * Are the source and destination repositories directly related?
          * Is the source revision still not present in the destination?
 
+         The revisions are only checked for new pull requests or when
+         they change.
+
          Additionally the owner is set to the destination's owner if he
          is a maintainer and the cc field is populated with the
          destination repository's maintainers. 
@@ -226,27 +296,34 @@ class PullrequestModule(Component):
         errors = []
         if ticket['type'] == 'pull request':
             rm = RepositoryManager(self.env)
-            repo = rm.get_repository_by_id(ticket['pr_srcrepo'], True)
+            repo, dstrepo = rm.get_repositories_by_ids((ticket['pr_srcrepo'],
+                                                        ticket['pr_dstrepo']),
+                                                       True)
             assert repo.is_fork
 
-            if rm.get_repository_by_id(ticket['pr_dstrepo'], True) != repo.origin:
+            if dstrepo != repo.origin:
                 msg = _("Pull requests must go from a fork to its origin.")
                 errors.append((None, msg))
 
-            src_rev_in_src = repo.has_node('', ticket['src_rev'])
-            src_rev_in_dst = repo.origin.has_node('', ticket['src_rev'])
-            dst_rev_in_src = repo.has_node('', ticket['src_rev'])
-            dst_rev_in_dst = repo.origin.has_node('', ticket['src_rev'])
-
-            if not src_rev_in_src:
+            # Existing pull requests must stay editable after their
+            # revisions got merged or deleted, so the revisions are only
+            # checked when they are set.
+            srcrev, dstrev = ticket['pr_srcrev'], ticket['pr_dstrev']
+            check_srcrev = not ticket.exists or 'pr_srcrev' in ticket._old
+            check_dstrev = not ticket.exists or 'pr_dstrev' in ticket._old
+            if check_srcrev or check_dstrev:
+                in_src = repo.get_existing_revisions([srcrev, dstrev])
+                in_dst = repo.origin.get_existing_revisions([srcrev, dstrev])
+
+            if check_srcrev and srcrev not in in_src:
                 msg = _("Source revision must exist in source repository.")
                 errors.append((None, msg))
 
-            if not src_rev_in_dst or ticket['status'] == 'accepted':
+            if check_srcrev and srcrev in in_dst:
                 msg = _("Revision is already pulled but request not accepted.")
                 errors.append((None, msg))
 
-            if not (dst_rev_in_src and dst_rev_in_dst):
+            if check_dstrev and not (dstrev in in_src and dstrev in in_dst):
                 msg = _("Destination revision must exist in both repositories.")
                 errors.append((None, msg))
 
@@ -293,25 +370,90 @@ class PullrequestModule(Component):
         ticket = data['ticket']
 
         rm = RepositoryManager(self.env)
-        srcrepo = rm.get_repository_by_id(ticket['pr_srcrepo'], True)
-        dstrepo = rm.get_repository_by_id(ticket['pr_dstrepo'], True)
+        srcrepo, dstrepo = rm.get_repositories_by_ids((ticket['pr_srcrepo'],
+                                                       ticket['pr_dstrepo']),
+                                                      True)
         assert not (srcrepo and dstrepo) or srcrepo.origin == dstrepo
         assert ticket['status'] == 'closed' or (srcrepo and dstrepo)
 
         srcrev = ticket['pr_srcrev']
         srcrev_list = []
-        candidate = srcrev
+        srcrev_more = None
+        ahead_behind = None
         if ticket['status'] != 'closed':
-            while candidate is not None:
-                srcrev_list.append(candidate)
-                candidate = srcrepo.next_rev(candidate)
+            start = req.args.get('pr_srcrev_start') or srcrev
+            if start != srcrev and \
+                    not srcrepo.get_existing_revisions([start]):
+                start = srcrev
+            srcrev_list, srcrev_more = self._get_srcrev_list(srcrepo, srcrev,
+                                                             start)
+            if start != srcrev:
+                srcrev_list = [srcrev] + srcrev_list
+            ahead_behind = self._get_ahead_behind(srcrepo, srcrev)
 
         data.update({'pr_srcrepo': srcrepo,
                      'pr_srcrev': srcrev,
                      'pr_srcrev_list': srcrev_list,
+                     'pr_srcrev_more': srcrev_more,
+                     'pr_ahead_behind': ahead_behind,
                      'pr_dstrepo': dstrepo,
                      'pr_dstrev': ticket['pr_dstrev']})
 
+    def _get_srcrev_list(self, srcrepo, srcrev, start):
+        """Return the descendants of `srcrev` on its branch, beginning
+        at `start`, at most `pr_srcrev_list_size` of them.
+
+        The second item of the result is the revision to continue with
+        if the list was capped, otherwise `None`. Changesets on other
+        branches are skipped, not treated as the end of the list.
+        Connectors that cannot select descendants only offer `start`.
+        Results are cached per fork, revisions and youngest revision of
+        the fork, so the history is only queried again when the fork
+        changes.
+        """
+        def compute():
+            size = max(1, self.srcrev_list_size)
+            rm = RepositoryManager(self.env)
+            revs = rm.get_descendants(srcrepo, srcrev, start, size + 1)
+            if revs is None:
+                revs = [start]
+            more = revs[size] if len(revs) > size else None
+            return revs[:size], more
+
+        key = (srcrepo.id, srcrev, start, srcrepo.youngest_rev)
+        return self._get_cached(self._srcrev_lists, key, compute)
+
+    def _get_ahead_behind(self, srcrepo, srcrev):
+        """Return how far `srcrev` of the fork is ahead of and behind
+        its origin.
+
+        Results are cached per fork, revision and youngest revisions of
+        the fork and its origin, so viewing a pull request only queries
+        the repositories again after one of them changed.
+        """
+        key = (srcrepo.id, srcrev, srcrepo.youngest_rev,
+               srcrepo.origin.youngest_rev)
+        rm = RepositoryManager(self.env)
+        return self._get_cached(self._ahead_behind, key,
+                                lambda: rm.get_ahead_behind(srcrepo, srcrev))
+
+    def _get_cached(self, cache, key, compute):
+        """Return the value of `key` in the LRU dict `cache`, calling
+        `compute` to create it if it is missing.
+        """
+        with self._srcrev_lock:
+            if key in cache:
+                value = cache.pop(key)
+                cache[key] = value
+                return value
+
+        value = compute()
+        with self._srcrev_lock:
+            cache[key] = value
+            while len(cache) > self.srcrev_cache_size:
+                cache.popitem(last=False)
+        return value
+
     def _post_process_newticket_request(self, req, data):
         """Setup data from the provided source repository."""
         repo = data.get('pr_srcrepo')
@@ -319,55 +461,226 @@ class PullrequestModule(Component):
 
         srcrev = data['ticket']['pr_srcrev']
 
+        rm = RepositoryManager(self.env)
+        dstrev = rm.get_youngest_common_ancestor(repo, srcrev)
+
         data.update({'pr_srcrepo': repo,
                      'pr_srcrev': srcrev,
                      'pr_srcrev_list': [],
                      'pr_dstrepo': repo.origin,
-                     'pr_dstrev': repo.get_youngest_common_ancestor(srcrev)})
+                     'pr_dstrev': dstrev})
 
-    def _render_diff_html(self, req, data):
+    def _render_diff_html(self, req, data, preview=False):
         """Use Trac's rendering to show the changes in the pull request.
-        
+
         To exploit Trac's built-in HTML rendering for diffs we must
         setup a fresh data dict and call the internal method
-        `_render_html` of the `ChangesetModule`.
+        `_render_html` of the `ChangesetModule`. The result is rendered
+        into a HTML fragment that is stored as `pr_diff_html` in the
+        original data.
 
-        Afterwards the `diff_data` must be added to the original data
-        without replacing existing keys. An exception helps to find
-        those keys that must be renamed. Remember to adapt the Genshi
-        templates accordingly.
+        Rendered diffs are kept in the `DiffCache`, keyed on the
+        revisions, the diff options, the view permissions and, as lazy
+        diffs link to it, the ticket. For automatic previews (`preview`)
+        only a cached diff is used and nothing is rendered.
 
         XHR must be disabled even for automatic preview as Trac's
         rendering otherwise aborts request processing and immediately
         sends a result to the browser.
         """
+        data['pr_diff_html'] = None
+        repo = data['pr_srcrepo'] or data['pr_dstrepo']
+        if not repo:
+            return
+
         style, options, diff = get_diff_options(req)
+        perm = req.perm(repo.resource)
+        cache = DiffCache(self.env)
+        key = cache.make_key(repo.id, data['pr_dstrev'], data['pr_srcrev'],
+                             style, sorted(options), unicode(req.locale),
+                             'CHANGESET_VIEW' in perm, 'FILE_VIEW' in perm,
+                             data['ticket'].id, self.lazy_diff_threshold)
+        html = cache.get(key)
+        if html is None and not preview:
+            html = self._render_diff(req, repo, data, diff)
+            if html is not None:
+                cache.put(key, html)
+        if html is not None:
+            data['pr_diff_html'] = Markup(html)
+
+    def _render_diff(self, req, repo, data, diff):
+        """Render the diff of a pull request and return the HTML or
+        `None` if the source revision does not exist.
+
+        If more than `pr_lazy_diff_threshold` files changed, only the
+        list of files is rendered.
+        """
+        if not repo.get_existing_revisions([data['pr_srcrev']]):
+            return None
+
+        if self.lazy_diff_threshold > 0:
+            changes = list(repo.get_changes('', data['pr_dstrev'],
+                                            '', data['pr_srcrev']))
+            if len(changes) > self.lazy_diff_threshold:
+                return self._render_lazy_diff(req, repo, data, changes)
 
         cm = ChangesetModule(self.env)
-        diff_data = {}
-        repo = data['pr_srcrepo'] or data['pr_dstrepo']
+        diff_data = {'old_path': '',
+                     'old_rev': data['pr_dstrev'],
+                     'new_path': '',
+                     'new_rev': data['pr_srcrev'],
+                     'repos': repo,
+                     'reponame': repo.reponame,
+                     'diff': diff,
+                     'wiki_format_messages': cm.wiki_format_messages}
 
-        if not (repo and repo.has_node('', data['pr_srcrev'])):
-            return
+        cm._render_html(req, repo, False, True, False, diff_data)
 
-        diff_data.update({'old_path': '',
-                          'old_rev': data['pr_dstrev'],
-                          'new_path': '',
-                          'new_rev': data['pr_srcrev'],
-                          'repos': repo,
-                          'reponame': repo.reponame,
-                          'diff': diff,
-                          'wiki_format_messages': cm.wiki_format_messages})
+        stream = Chrome(self.env).render_template(req, 'diff.html',
+                                                  diff_data, fragment=True)
+        return stream.render('xhtml', encoding=None)
 
-        cm._render_html(req, repo, False, True, False, diff_data)
+    def _render_lazy_diff(self, req, repo, data, changes):
+        """Render the list of changed files of a pull request, with a
+        link for each file that loads its diff on demand.
+        """
+        ticket = data['ticket']
+        classes = {'add': 'add', 'delete': 'rem', 'copy': 'cp',
+                   'move': 'mv', 'edit': 'mod'}
+        kinds = {'add': _("added"), 'delete': _("deleted"),
+                 'copy': _("copied"), 'move': _("moved"),
+                 'edit': _("modified")}
+        items = []
+        for old_node, new_node, kind, change in changes:
+            if change not in classes:
+                continue
+            old_path = old_node.path if old_node else ''
+            new_path = new_node.path if new_node else ''
+            if change == 'delete':
+                path, rev = old_path, data['pr_dstrev']
+            else:
+                path, rev = new_path, data['pr_srcrev']
+            if ticket.exists:
+                diff_href = req.href.ticket(ticket.id, 'diff',
+                                            diff_old_path=old_path,
+                                            diff_new_path=new_path)
+            else:
+                diff_href = req.href.newpullrequest(repo.reponame,
+                                                    pr_srcrev=data['pr_srcrev'],
+                                                    diff_old_path=old_path,
+                                                    diff_new_path=new_path)
+            items.append({'path': path.strip('/'),
+                          'class': classes[change],
+                          'kind': kinds[change],
+                          'href': req.href.browser(repo.reponame, path,
+                                                   rev=rev),
+                          'diff_href': diff_href if kind == 'file' else None})
+
+        stream = Chrome(self.env).render_template(
+            req, 'pullrequest_diff_lazy.html', {'items': items},
+            fragment=True)
+        return stream.render('xhtml', encoding=None)
+
+    def _process_diff_request(self, req, repo, dstrev, srcrev):
+        """Send the diff of a single file between the given revisions as
+        HTML fragment.
+
+        `diff_old_path` names the file at `dstrev` and `diff_new_path`
+        at `srcrev`. One of them is empty for added and deleted files,
+        whose whole content is shown as inserted or removed.
+        """
+        old_path = req.args.get('diff_old_path', '')
+        new_path = req.args.get('diff_new_path', '')
+        old_node = new_node = None
+        if repo:
+            if old_path and repo.has_node(old_path, dstrev):
+                old_node = repo.get_node(old_path, dstrev)
+            if new_path and repo.has_node(new_path, srcrev):
+                new_node = repo.get_node(new_path, srcrev)
+        if (old_path and not old_node) or (new_path and not new_node) or \
+                not (old_node or new_node):
+            raise ResourceNotFound(_("No such file in the pull request."))
 
-        for key in diff_data:
-            diff_key = key
-            if key in ['changes']:
-                diff_key = 'diff_' + key
-            if diff_key in data:
-                raise TracError("Key %(key)s collides in data", diff_key)
-            data[diff_key] = diff_data[key]
+        style, options, diff = get_diff_options(req)
+        perm = req.perm(repo.resource)
+        cache = DiffCache(self.env)
+        key = cache.make_key(repo.id, dstrev, srcrev, old_path, new_path,
+                             style, sorted(options), unicode(req.locale),
+                             'CHANGESET_VIEW' in perm, 'FILE_VIEW' in perm)
+        html = cache.get(key)
+        if html is None:
+            cm = ChangesetModule(self.env)
+            diff_data = {'old_path': old_path,
+                         'old_rev': dstrev,
+                         'new_path': new_path,
+                         'new_rev': srcrev,
+                         'repos': repo,
+                         'reponame': repo.reponame,
+                         'diff': diff,
+                         'wiki_format_messages': cm.wiki_format_messages}
+            if old_node and new_node:
+                cm._render_html(req, repo, False, True, False, diff_data)
+            else:
+                self._render_content_diff(req, repo, old_node, new_node,
+                                          dstrev, srcrev, diff_data)
+            stream = Chrome(self.env).render_template(
+                req, 'pullrequest_diff_file.html', diff_data, fragment=True)
+            html = stream.render('xhtml', encoding=None)
+            cache.put(key, html)
+        req.send(html.encode('utf-8'), 'text/html')
+
+    def _render_content_diff(self, req, repo, old_node, new_node, dstrev,
+                             srcrev, data):
+        """Setup `data` for `diff_div.html` with the diff of an added
+        (`old_node` is `None`) or deleted (`new_node` is `None`) file.
+
+        Trac's own diff rendering requires both nodes, so the diff
+        against empty content is built here the same way.
+        """
+        node = old_node or new_node
+        req.perm(node.resource).require('FILE_VIEW')
+
+        cm = ChangesetModule(self.env)
+        diffs = []
+        if node.content_length <= cm.max_diff_bytes:
+            content = node.get_content().read()
+            if not is_binary(content):
+                mimeview = Mimeview(self.env)
+                lines = mimeview.to_unicode(content,
+                                            node.content_type).splitlines()
+                options = data['diff']['options']
+                context = options.get('contextlines', 3)
+                if context < 0:
+                    context = None
+                tabwidth = self.config['diff'].getint('tab_width') or \
+                           self.config['mimeviewer'].getint('tab_width', 8)
+                old_lines, new_lines = ([], lines) if new_node else (lines, [])
+                ignore = {
+                    'ignore_blank_lines': options.get('ignoreblanklines'),
+                    'ignore_case': options.get('ignorecase'),
+                    'ignore_space_changes': options.get('ignorewhitespace')}
+                diffs = diff_blocks(old_lines, new_lines, context, tabwidth,
+                                    **ignore)
+
+        def info(path, rev):
+            return {'path': path,
+                    'rev': rev,
+                    'shortrev': repo.short_rev(rev),
+                    'href': req.href.browser(repo.reponame, path, rev=rev)}
+
+        old = info(node.path, dstrev)
+        new = info(node.path, srcrev)
+        if old_node is None:
+            old['href'] = None
+        else:
+            new['href'] = None
+        data.update({'changes': [{'change': 'add' if new_node else 'delete',
+                                  'old': old,
+                                  'new': new,
+                                  'props': [],
+                                  'diffs': diffs}],
+                     'longcol': 'Revision',
+                     'shortcol': 'r'})
 
 class BrowserModule(Component):
     """Add navigation items to the browser."""
@@ -383,18 +696,13 @@ class BrowserModule(Component):
             rm = RepositoryManager(self.env)
             path = req.args.get('path', '/')
             reponame, repo, path = rm.get_repository_by_path(path)
-            if repo:
-                try:
-                    convert_managed_repository(self.env, repo)
-                    allowed = set()
-                    if repo.is_fork:
-                        allowed = set([repo.owner]) | repo.maintainers()
-                    if 'TICKET_CREATE' in req.perm and req.authname in allowed:
-                        rev = req.args.get('rev')
-                        href = req.href.newpullrequest(reponame, pr_srcrev=rev)
-                        add_ctxtnav(req, _("Open Pull Request"), href)
-                except:
-                    pass
+            repo = repo and rm.get_request_repository(req, reponame)
+            if repo and repo.is_fork:
+                allowed = set([repo.owner]) | repo.maintainers()
+                if 'TICKET_CREATE' in req.perm and req.authname in allowed:
+                    rev = req.args.get('rev')
+                    href = req.href.newpullrequest(reponame, pr_srcrev=rev)
+                    add_ctxtnav(req, _("Open Pull Request"), href)
         return template, data, content_type
 
     ### Private methods
@@ -1,17 +1,30 @@
 from ..api import *
 
 from trac.util.translation import _
+from trac.config import ChoiceOption
 
 from ConfigParser import ConfigParser
 
 import hglib
 import os
+import shutil
 
 class MercurialConnector(Component):
     """Add support for creating and managing HG repositories."""
 
     implements(IAdministrativeRepositoryConnector)
 
+    fork_mode = ChoiceOption('repository-manager', 'hg_fork_mode',
+                             ['hardlink', 'pull'],
+                             doc="""How local forks of hg repositories are
+                                    cloned. `hardlink` lets Mercurial share
+                                    the revlogs of the origin via hardlinks
+                                    (falling back to copies where that is
+                                    not possible) and uses `pull` if that
+                                    fails. `pull` always copies every
+                                    changeset using the pull protocol.
+                                    """)
+
     def get_supported_types(self):
         yield ('hg', 0)
 
@@ -35,12 +48,60 @@ class MercurialConnector(Component):
             raise TracError(_("Failed to initialize repository: ") + str(e))
 
     def fork(self, repo):
+        origin = repo['origin_url']
+        if self.fork_mode == 'hardlink' and origin.startswith('file://'):
+            try:
+                hglib.clone(origin[len('file://'):], repo['dir'],
+                            updaterev='null', pull=False)
+                return
+            except Exception, e:
+                self.log.warning("Failed to clone %s using hardlinks, "
+                                 "falling back to pull: %s", origin, e)
+                if os.path.lexists(repo['dir']):
+                    shutil.rmtree(repo['dir'])
         try:
-            hglib.clone(repo['origin_url'], repo['dir'],
-                        updaterev='null', pull=True)
+            hglib.clone(origin, repo['dir'], updaterev='null', pull=True)
         except Exception, e:
             raise TracError(_("Failed to clone repository: ") + str(e))
 
+    def get_existing_revisions(self, repo, revs):
+        normalized = dict((rev, self._normalize_rev(rev)) for rev in set(revs))
+        valid = sorted(set(filter(None, normalized.values())))
+        if not valid:
+            return set()
+        revset = ' + '.join(['present(%s)'] * len(valid))
+        existing = set()
+        for number, node in self._query(repo, revset, *valid):
+            existing |= set(rev for rev, value in normalized.iteritems()
+                            if value and (value == str(number) or
+                                          node.startswith(value)))
+        return existing
+
+    def get_ahead_behind(self, repo, rev, other):
+        rev = self._normalize_rev(rev)
+        if not rev:
+            return None
+        ahead = self._query(repo, '::%s and outgoing(%s)', rev,
+                            other.directory)
+        behind = self._query(other, 'outgoing(%s)', repo.directory)
+        return len(ahead), len(behind)
+
+    def get_descendants(self, repo, rev, start, limit):
+        rev, start = self._normalize_rev(rev), self._normalize_rev(start)
+        if not (rev and start):
+            return []
+        return [node for number, node in self._query(
+                    repo, 'limit(descendants(%s) and branch(%s) and %s:, %d)',
+                    rev, rev, start, limit)]
+
+    def get_merge_base(self, repo, rev, other):
+        rev = self._normalize_rev(rev)
+        if not rev:
+            return None
+        nodes = self._query(repo, 'max(::%s - outgoing(%s))', rev,
+                            other.directory)
+        return nodes[0][1] if nodes else None
+
     def delete_changeset(self, repo, rev, ban):
         try:
             from mercurial import ui, hg, repair
@@ -70,19 +131,16 @@ class MercurialConnector(Component):
                 hgrc.add_section('hgban')
             hgrc.set('hgban', 'revsets', revsets  + "\n" + rev)
 
-            with open(hgrc_path, 'wb') as hgrc_file:
-                hgrc.write(hgrc_file)
-                try:
-                    modes = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-                    os.chmod(hgrc_path, modes)
-                except:
-                    pass
+            write_auth_file(hgrc_path, hgrc)
 
-    def update_auth_files(self, repositories):
+    def update_auth_files(self, repositories, incremental=False,
+                          groups=None):
+        groups = groups or UserGroups(self.env)
+        changed = 0
         for repo in repositories:
             writers = repo.maintainers() | repo.writers()
-            writers = expand_user_set(self.env, writers)
-            readers = expand_user_set(self.env, writers | repo.readers())
+            writers = groups.expand(writers)
+            readers = groups.expand(writers | repo.readers())
 
             hgrc_path = os.path.join(repo.directory, '.hg/hgrc')
 
@@ -118,10 +176,34 @@ class MercurialConnector(Component):
             else:
                 apply_user_list(writers, 'push')
 
-            with open(hgrc_path, 'wb') as hgrc_file:
-                hgrc.write(hgrc_file)
-            try:
-                modes = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-                os.chmod(hgrc_path, modes)
-            except:
-                pass
+            changed += write_auth_file(hgrc_path, hgrc)
+        return changed
+
+    ### Private methods
+    def _normalize_rev(self, rev):
+        """Return `rev` as a revision number or node that can be passed
+        to a revset, dropping the revision number Trac shows in front of
+        the node in the `rev:node` form.
+        """
+        rev = rev and unicode(rev).strip().split(':')[-1]
+        return rev.encode('utf-8') if rev else None
+
+    def _query(self, repo, revset, *args):
+        """Return `(rev, node)` pairs for all changesets of the given
+        revset, which may contain `formatspec` placeholders for `args`.
+
+        The revset is evaluated in-process by the Mercurial repository
+        object Trac already holds open for `repo`, so no `hg` process
+        is spawned.
+        """
+        from mercurial import error
+        from mercurial.node import hex
+        hg_repo = getattr(repo, 'repo', None)
+        if hg_repo is None:
+            from mercurial import ui, hg
+            hg_repo = hg.repository(ui.ui(), repo.directory)
+        try:
+            return [(rev, hex(hg_repo.changelog.node(rev)))
+                    for rev in hg_repo.revs(revset, *args)]
+        except (error.LookupError, error.RepoLookupError):
+            return []
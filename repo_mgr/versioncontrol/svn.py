@@ -49,6 +49,26 @@ class SubversionConnector(Component):
     def can_ban_changesets(self, type):
         return False
 
+    def get_existing_revisions(self, repo, revs):
+        youngest = int(repo.get_youngest_rev())
+        existing = set()
+        for rev in revs:
+            try:
+                if 0 <= int(rev) <= youngest:
+                    existing.add(rev)
+            except (TypeError, ValueError):
+                pass
+        return existing
+
+    def get_ahead_behind(self, repo, rev, other):
+        return None
+
+    def get_descendants(self, repo, rev, start, limit):
+        return None
+
+    def get_merge_base(self, repo, rev, other):
+        return False
+
     def create(self, repo):
         try:
             characters = string.ascii_lowercase + string.digits
@@ -73,13 +93,18 @@ class SubversionConnector(Component):
         except Exception, e:
             raise TracError(_("Failed to initialize repository: ") + str(e))
 
-    def update_auth_files(self, repositories):
+    def update_auth_files(self, repositories, incremental=False,
+                          groups=None):
         if not self.svn_authz_file:
-            return
+            return 0
 
         authz_path = os.path.join(self.env.path, self.svn_authz_file)
 
         authz = ConfigParser()
+        if incremental:
+            authz.read(authz_path)
+
+        user_groups = groups or UserGroups(self.env)
 
         groups = set()
         for repo in repositories:
@@ -87,15 +112,18 @@ class SubversionConnector(Component):
             groups |= {name for name in repo.writers() if name[0] == '@'}
             groups |= {name for name in repo.readers() if name[0] == '@'}
 
-        authz.add_section('groups')
+        if not authz.has_section('groups'):
+            authz.add_section('groups')
         for group in groups:
-            members = expand_user_set(self.env, [group])
+            members = user_groups.get_members(group)
             authz.set('groups', group[1:], ', '.join(sorted(members)))
-        authenticated = sorted({u[0] for u in self.env.get_known_users()})
-        authz.set('groups', 'authenticated', ', '.join(authenticated))
+        if not (incremental and authz.has_option('groups', 'authenticated')):
+            authenticated = sorted(user_groups.known_users)
+            authz.set('groups', 'authenticated', ', '.join(authenticated))
 
         for repo in repositories:
             section = repo.reponame + ':/'
+            authz.remove_section(section)
             authz.add_section(section)
             rw = repo.maintainers() | repo.writers()
             r = repo.readers() - rw
@@ -122,10 +150,4 @@ class SubversionConnector(Component):
             apply_user_list(r, 'r')
 
         RepositoryManager(self.env)._prepare_base_directory(authz_path)
-        with open(authz_path, 'wb') as authz_file:
-            authz.write(authz_file)
-        try:
-            modes = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP
-            os.chmod(authz_path, modes)
-        except:
-            pass
+        return int(write_auth_file(authz_path, authz))
@@ -1,20 +1,26 @@
 from api import *
+from jobs import RepositoryJobQueue
 
 from trac.core import *
 from trac.perm import IPermissionRequestor, PermissionError, PermissionSystem
 from trac.web import IRequestHandler, IRequestFilter
 from trac.web.auth import LoginModule
 from trac.web.chrome import INavigationContributor, ITemplateProvider, \
-                            add_ctxtnav, add_stylesheet, \
-                            add_notice, add_warning
+                            add_ctxtnav, add_link, add_script, \
+                            add_stylesheet, add_notice, add_warning, \
+                            web_context
+from trac.resource import Resource
 from trac.versioncontrol.admin import RepositoryAdminPanel
 from trac.versioncontrol.svn_authz import AuthzSourcePolicy
-from trac.ticket.model import Ticket
-from trac.util import is_path_below, as_bool
+from trac.versioncontrol.web_ui.browser import BrowserModule \
+                                              as TracBrowserModule
+from trac.versioncontrol.web_ui.util import get_path_links
+from trac.util import embedded_numbers, is_path_below, as_bool
+from trac.util.presentation import Paginator
 from trac.util.translation import _, tag_
 from trac.util.text import normalize_whitespace, \
                            unicode_to_base64, unicode_from_base64
-from trac.config import Option, BoolOption
+from trac.config import Option, BoolOption, IntOption
 
 from genshi.builder import tag
 
@@ -55,9 +61,13 @@ class RepositoryManagerModule(Component):
         """Hook into requests that change the user database.
 
         When the user database changes, we must update our auth files.
+        The rebuild is queued as a job, so that changes made in quick
+        succession are handled by a single rebuild.
         """
         if req.path_info == '/admin/general/perm':
-            RepositoryManager(self.env).update_auth_files()
+            if RepositoryManager(self.env).check_permissions_changed():
+                RepositoryJobQueue(self.env).submit('update_auth_files', '',
+                                                    None, req.authname)
 
         return template, data, content_type
 
@@ -94,6 +104,8 @@ class RepositoryManagerModule(Component):
             self._process_modify_request(req, data)
         elif action == 'remove':
             self._process_remove_request(req, data)
+        elif action == 'job':
+            self._process_job_request(req, data)
 
 #        add_stylesheet(req, 'common/css/browser.css')
         add_stylesheet(req, 'common/css/admin.css')
@@ -123,17 +135,26 @@ class RepositoryManagerModule(Component):
         remote_fork = self._get_repository_data_from_request(req, 'remote_')
 
         if req.args.get('create'):
-            self._create(req, repository, rm.create)
+            self._create(req, repository, 'create')
 
         elif req.args.get('fork_remote'):
-            self._create(req, remote_fork, rm.fork_remote)
+            add_warning(req, _("Forking remote repositories is not "
+                               "supported."))
 
         self._process_fork_request(req, data)
 
+        forkable_repositories = rm.get_forkable_repositories()
+        if not 'REPOSITORY_ADMIN' in req.perm:
+            managed = rm.access_index['managed']
+            accessible = rm.get_accessible_repositories(req.authname)
+            forkable_repositories = dict(
+                (key, name) for key, name in forkable_repositories.iteritems()
+                if name not in managed or name in accessible)
+
         data.update({'title': _("Create Repository"),
                      'supported_repository_types': rm.get_supported_types(),
                      'forkable_repository_types': rm.get_forkable_types(),
-                     'forkable_repositories': rm.get_forkable_repositories(),
+                     'forkable_repositories': forkable_repositories,
                      'repository': repository,
                      'local_fork': data.get('local_fork', {}),
                      'remote_fork': remote_fork})
@@ -157,7 +178,7 @@ class RepositoryManagerModule(Component):
             origin = self._get_checked_repository(req, local_fork['origin'],
                                                   False, 'REPOSITORY_FORK')
             local_fork.update({'type': origin.type})
-            self._create(req, local_fork, rm.fork_local)
+            self._create(req, local_fork, 'fork_local')
 
         repo_link = tag.a(origin_name, href=req.href.browser(origin_name))
         data.update({'title': tag_("Fork Repository %(link)s", link=repo_link),
@@ -204,7 +225,7 @@ class RepositoryManagerModule(Component):
                 decode = unicode_from_base64
                 roles = [(decode(role[0]), decode(role[1])) for role in roles]
                 rm.revoke_roles(repo, roles)
-                rm.update_auth_files()
+                rm.update_auth_files(incremental=True)
                 req.redirect(req.href(req.path_info))
         elif req.args.get('cancel'):
             LoginModule(self.env)._redirect_back(req)
@@ -231,24 +252,12 @@ class RepositoryManagerModule(Component):
         repo = self._get_checked_repository(req, req.args.get('reponame'))
 
         open_ticket = None
-        with self.env.db_transaction as db:
-            tickets = db("""SELECT ticket FROM (
-                                SELECT src.ticket,
-                                       src.value as srcrepo,
-                                      dst.value as dstrepo
-                                FROM ticket_custom AS src JOIN
-                                     ticket_custom AS dst ON
-                                     (src.ticket = dst.ticket)
-                                WHERE src.name = 'pr_srcrepo' AND
-                                      dst.name = 'pr_dstrepo')
-                            WHERE srcrepo = %d OR dstrepo = %d
-                            """ % (repo.id, repo.id))
-            for values in tickets:
-                (id,) = values
-                ticket = Ticket(self.env, id)
-                if ticket['status'] != 'closed':
-                    open_ticket = id
-                    break
+        for id, in self.env.db_query("""
+                SELECT ticket FROM pull_request
+                WHERE (srcrepo = %s OR dstrepo = %s) AND status != 'closed'
+                LIMIT 1
+                """, (repo.id, repo.id)):
+            open_ticket = id
 
         if open_ticket:
             link = tag.a(_("pull request"), href=req.href.ticket(open_ticket))
@@ -259,6 +268,8 @@ class RepositoryManagerModule(Component):
 
         if req.args.get('confirm'):
             RepositoryManager(self.env).remove(repo, req.args.get('delete'))
+            RepositoryJobQueue(self.env).submit('purge_removed', '', {},
+                                                req.authname)
             add_notice(req, _('The repository "%(name)s" has been removed.',
                               name=repo.reponame))
             req.redirect(req.href.repository())
@@ -268,6 +279,35 @@ class RepositoryManagerModule(Component):
         data.update({'title': _("Remove Repository"),
                      'repository': repo})
 
+    def _process_job_request(self, req, data):
+        """Show the status of a queued repository operation along with
+        the recent operations of the user.
+        """
+        jobs = RepositoryJobQueue(self.env)
+        is_admin = 'REPOSITORY_ADMIN' in req.perm
+
+        job = None
+        id = req.args.get('reponame')
+        if id:
+            try:
+                job = jobs.get_job(int(id))
+            except ValueError:
+                pass
+            if not job:
+                raise TracError(_('Job "%(id)s" does not exist.', id=id))
+            if not (job['submitter'] == req.authname or is_admin):
+                raise PermissionError(_('You (%(user)s) did not submit job '
+                                        '"%(id)s"', user=req.authname, id=id))
+
+        refresh = None
+        if job and job['status'] in jobs.active_states:
+            refresh = 3
+
+        data.update({'title': _("Repository Jobs"),
+                     'job': job,
+                     'jobs': jobs.get_jobs(None if is_admin else req.authname),
+                     'refresh': refresh})
+
     def _get_checked_repository(self, req, name, owner=True, permission=None):
         """Check if a repository exists and the user is the owner and
         has the given permission. Finally return the repository.
@@ -292,18 +332,18 @@ class RepositoryManagerModule(Component):
 
         return repository
 
-    def _create(self, req, repo, creator):
-        """Check if a repository can be created and create it using the
-        given creator function.
+    def _create(self, req, repo, action):
+        """Check if a repository can be created and queue the given
+        `RepositoryManager` action to create it.
         """
         if not repo['name']:
             add_warning(req, _("Missing arguments to create a repository."))
         elif self._check_and_update_repository(req, repo):
-            creator(repo)
-            link = tag.a(repo['name'], href=req.href.browser(repo['name']))
-            add_notice(req, tag_('The repository "%(link)s" has been created.',
-                                 link=link))
-            req.redirect(req.href.repository('modify', repo['name']))
+            jobs = RepositoryJobQueue(self.env)
+            id = jobs.submit(action, repo['name'], repo, req.authname)
+            add_notice(req, _('The repository "%(name)s" is being created.',
+                              name=repo['name']))
+            req.redirect(req.href.repository('job', id))
 
     def _check_and_update_repository(self, req, repo, old_repo=None):
         """Check if a repository is valid, does not already exist,
@@ -373,7 +413,7 @@ class RepositoryManagerModule(Component):
                 subject = req.args.get(role)
                 if subject:
                     rm.add_role(repo, role, subject)
-                    rm.update_auth_files()
+                    rm.update_auth_files(incremental=True)
                     return True
                 add_warning(req, _("Please choose an option from the list."))
         return False
@@ -428,25 +468,22 @@ class BrowserModule(Component):
             path = req.args.get('path', '/')
             reponame, repo, path = rm.get_repository_by_path(path)
             if repo:
-                if path == '/':
-                    try:
-                        convert_managed_repository(self.env, repo)
-                        if 'REPOSITORY_FORK' in req.perm and repo.is_forkable:
-                            href = req.href.repository('fork', repo.reponame)
-                            add_ctxtnav(req, _("Fork"), href)
-                        if (repo.owner == req.authname or
-                            'REPOSITORY_ADMIN' in req.perm):
-                            href = req.href.repository('modify', repo.reponame)
-                            add_ctxtnav(req, _("Modify"), href)
-                            href = req.href.repository('remove', repo.reponame)
-                            add_ctxtnav(req, _("Remove"), href)
-                        if repo.is_fork:
-                            origin = repo.origin.reponame
-                            add_ctxtnav(req, _("Forked from %(origin)s",
-                                               origin=origin),
-                                        req.href.browser(origin))
-                    except:
-                        pass
+                repo = path == '/' and rm.get_request_repository(req, reponame)
+                if repo:
+                    if 'REPOSITORY_FORK' in req.perm and repo.is_forkable:
+                        href = req.href.repository('fork', repo.reponame)
+                        add_ctxtnav(req, _("Fork"), href)
+                    if (repo.owner == req.authname or
+                        'REPOSITORY_ADMIN' in req.perm):
+                        href = req.href.repository('modify', repo.reponame)
+                        add_ctxtnav(req, _("Modify"), href)
+                        href = req.href.repository('remove', repo.reponame)
+                        add_ctxtnav(req, _("Remove"), href)
+                    if repo.is_fork:
+                        origin = repo.origin.reponame
+                        add_ctxtnav(req, _("Forked from %(origin)s",
+                                           origin=origin),
+                                    req.href.browser(origin))
             else:
                 if 'REPOSITORY_CREATE' in req.perm:
                     add_ctxtnav(req, _("Create Repository"),
@@ -455,27 +492,112 @@ class BrowserModule(Component):
         return template, data, content_type
 
 class RepositoryIndex(Component):
-    """Enhanced repository index with e.g. maintainer information."""
+    """Enhanced repository index with e.g. maintainer information.
+
+    The index can be filtered by owner, type and forks and is split into
+    pages of `index_page_size` repositories. Unless there is a default
+    repository, the index is rendered here, so that Trac only fetches
+    the youngest changesets of the repositories on the requested page.
+    """
 
-    implements(IRequestFilter, ITemplateProvider)
+    implements(INavigationContributor, IRequestFilter, IRequestHandler,
+               ITemplateProvider)
+
+    page_size = IntOption('repository-manager', 'index_page_size', 100,
+                          doc="""Number of repositories shown per page of
+                                 the repository index.
+                                 """)
 
     ### IRequestFilter methods
     def pre_process_request(self, req, handler):
+        if isinstance(handler, TracBrowserModule) and \
+                req.path_info.rstrip('/') == '/browser' and \
+                not (req.args.get('rev') or req.args.get('format')) and \
+                not req.get_header('X-Requested-With') and \
+                '' not in RepositoryManager(self.env).manager \
+                                                     .get_all_repositories():
+            return self
         return handler
 
     def post_process_request(self, req, template, data, content_type):
         if template == 'browser.html':
-            if data['repo'] and data['repo']['repositories']:
-                for i, values in enumerate(data['repo']['repositories']):
-                    try:
-                        convert_managed_repository(self.env, values[2])
-                    except:
-                        pass
-                data['list_maintainers'] = list_maintainers
+            if data['repo'] and data['repo']['repositories'] and \
+                    'repo_paginator' not in data:
+                self._filter_repository_index(req, data)
             template = 'repo_mgr_browser.html'
 
         return template, data, content_type
 
+    ### INavigationContributor methods
+    def get_active_navigation_item(self, req):
+        return 'browser'
+
+    def get_navigation_items(self, req):
+        return []
+
+    ### IRequestHandler methods
+    def match_request(self, req):
+        return False
+
+    def process_request(self, req):
+        """Render the repository index without a default repository.
+
+        The repositories are filtered, sorted and paginated by their
+        names, the managed metadata and the youngest revisions in
+        Trac's cache, before `BrowserModule` fetches the youngest
+        changesets of the page.
+        """
+        order = req.args.get('order', 'name').lower()
+        desc = as_bool(req.args.get('desc'))
+        rows = []
+        all_repositories = RepositoryManager(self.env).manager \
+                                                      .get_all_repositories()
+        for reponame, repoinfo in all_repositories.iteritems():
+            if not reponame or as_bool(repoinfo.get('hidden')):
+                continue
+            root = Resource('repository', reponame).child('source', '/')
+            if 'BROWSER_VIEW' in req.perm(root):
+                rows.append((reponame, repoinfo))
+
+        rows, annotations, filters = self._filter_rows(req, rows)
+        rows.sort(key=self._get_sort_key(order), reverse=desc)
+        page, page_size = self._get_page(req, len(rows))
+        start = (page - 1) * page_size
+
+        context = web_context(req)
+        repo_data = TracBrowserModule(self.env)._render_repository_index(
+            context, dict(rows[start:start + page_size]), order, desc)
+        paginator = Paginator(repo_data['repositories'], page - 1, page_size,
+                              len(rows))
+        self._add_page_links(req, paginator, filters, order, desc)
+        repo_data['repositories'] = paginator
+
+        data = {'context': context,
+                'reponame': '',
+                'repos': None,
+                'repoinfo': None,
+                'path': '/',
+                'rev': None,
+                'stickyrev': None,
+                'display_rev': lambda rev: rev,
+                'path_links': get_path_links(req.href, '', '/', None),
+                'order': order,
+                'desc': desc or None,
+                'repo': repo_data,
+                'dir': None,
+                'file': None,
+                'properties': None,
+                'quickjump_entries': None,
+                'wiki_format_messages':
+                    self.config['changeset'].getbool('wiki_format_messages'),
+                'repo_annotations': annotations,
+                'repo_paginator': paginator,
+                'repo_filters': filters}
+        add_script(req, 'common/js/expand_dir.js')
+        add_script(req, 'common/js/keyboard_nav.js')
+        add_stylesheet(req, 'common/css/browser.css')
+        return 'browser.html', data, None
+
     ### ITemplateProvider methods
     def get_templates_dirs(self):
         from pkg_resources import resource_filename
@@ -486,16 +608,123 @@ class RepositoryIndex(Component):
         return [('hw', resource_filename(__name__, 'htdocs'))]
 
     ### Private methods
-
-
-def list_maintainers(repository):
-    """Formats the list repository's maintainers for web display"""
-    try:
-        maintainers = repository.maintainers()
-        if maintainers:
-            return _("Maintainers: %(joined)s", joined=", ".join(maintainers))
-    except:
-        pass
+    def _filter_repository_index(self, req, data):
+        """Annotate, filter and paginate the repository index rendered
+        by Trac, which happens if there is a default repository.
+        """
+        rows, annotations, filters = self._filter_rows(
+            req, data['repo']['repositories'])
+        page, page_size = self._get_page(req, len(rows))
+        paginator = Paginator(rows, page - 1, page_size)
+        self._add_page_links(req, paginator, filters, req.args.get('order'),
+                             req.args.get('desc'))
+
+        data['repo']['repositories'] = paginator
+        data.update({'repo_annotations': annotations,
+                     'repo_paginator': paginator,
+                     'repo_filters': filters})
+
+    def _filter_rows(self, req, rows):
+        """Apply the filters given in `req.args` to `rows`, whose first
+        items are the name and info of a repository.
+
+        Returns the remaining rows, the annotations of the managed
+        repositories among them by name and the filter values.
+        """
+        rm = RepositoryManager(self.env)
+        metadata = rm.managed_metadata
+        owner = req.args.get('owner', '').strip()
+        repotype = req.args.get('repotype', '').strip()
+        forks = as_bool(req.args.get('forks'))
+
+        annotations = {}
+        types = set()
+        result = []
+        for row in rows:
+            reponame, repoinfo = row[0], row[1]
+            info = metadata.get(repoinfo.get('id'))
+            annotation = None
+            if info:
+                maintainers = set(info['maintainers'])
+                if rm.owner_as_maintainer:
+                    maintainers.add(info['owner'])
+                annotation = {'owner': info['owner'],
+                              'maintainers': sorted(filter(None, maintainers)),
+                              'origin': info['origin_name'],
+                              'type': repoinfo.get('type')}
+            types.add(repoinfo.get('type'))
+            if owner and not (annotation and annotation['owner'] == owner):
+                continue
+            if repotype and repoinfo.get('type') != repotype:
+                continue
+            if forks and not (annotation and annotation['origin']):
+                continue
+            annotations[reponame] = annotation
+            result.append(row)
+
+        filters = {'owner': owner, 'repotype': repotype, 'forks': forks,
+                   'types': sorted(filter(None, types))}
+        return result, annotations, filters
+
+    def _get_sort_key(self, order):
+        """Return the sort key for `(reponame, repoinfo)` pairs that
+        matches the ordering of Trac's repository index.
+
+        Dates and authors are taken from the youngest revision in Trac's
+        cache, so no repository is opened.
+        """
+        def name_key(row):
+            return embedded_numbers(row[0].lower())
+        if order not in ('date', 'author'):
+            return name_key
+
+        youngest = {}
+        for id, time, author in self.env.db_query("""
+                SELECT r.id, rev.time, rev.author
+                FROM repository AS r
+                JOIN revision AS rev ON (rev.repos = r.id AND
+                                         rev.rev = r.value)
+                WHERE r.name = 'youngest_rev'"""):
+            youngest[id] = (time or 0, (author or '').lower())
+        index = 0 if order == 'date' else 1
+        def key(row):
+            values = youngest.get(row[1].get('id'), (0, ''))
+            return values[index], name_key(row)
+        return key
+
+    def _get_page(self, req, count):
+        """Return the requested page number, limited to the available
+        pages, and the page size.
+        """
+        try:
+            page = max(1, int(req.args.get('page', 1)))
+        except ValueError:
+            page = 1
+        page_size = max(1, self.page_size)
+        return min(page, (count + page_size - 1) // page_size or 1), page_size
+
+    def _add_page_links(self, req, paginator, filters, order, desc):
+        """Setup the navigation of `paginator`, keeping the filters and
+        the sort order.
+        """
+        page = paginator.page + 1
+        args = {'owner': filters['owner'] or None,
+                'repotype': filters['repotype'] or None,
+                'forks': 1 if filters['forks'] else None,
+                'order': order if order != 'name' else None,
+                'desc': 1 if desc else None}
+        if paginator.has_next_page:
+            add_link(req, 'next', req.href.browser(page=page + 1, **args),
+                     _("Next Page"))
+        if paginator.has_previous_page:
+            add_link(req, 'prev', req.href.browser(page=page - 1, **args),
+                     _("Previous Page"))
+        paginator.shown_pages = [
+            {'href': req.href.browser(page=shown, **args), 'class': None,
+             'string': str(shown), 'title': _("Page %(num)d", num=shown)}
+            for shown in paginator.get_shown_pages(21)]
+        paginator.current_page = {'href': None, 'class': 'current',
+                                  'string': str(page), 'title': None}
 
 class ChangesetModule(Component):
     """Supports deleting and banning of changesets from managed repositories"""
@@ -519,9 +748,10 @@ class ChangesetModule(Component):
             rm = RepositoryManager(self.env)
             if rev and path:
                 reponame, repos, path = rm.get_repository_by_path(path)
-                convert_managed_repository(self.env, repos)
-                if (path == '/' and (repos.owner == req.authname or
-                                     'REPOSITORY_ADMIN' in req.perm)
+                repos = repos and rm.get_request_repository(req, reponame)
+                if (repos and path == '/' and
+                    (repos.owner == req.authname or
+                     'REPOSITORY_ADMIN' in req.perm)
                     and rm.can_delete_changesets(repos.type)):
                     add_ctxtnav(req, _("Delete Changeset"),
                                 req.href.deletechangeset(rev, reponame))